@@ -1,4 +1,4 @@
-from requests_html import HTMLSession
+from danbooru.bot.animedatabase_utils.transport import Transport
 
 
 class BaseService:
@@ -13,7 +13,7 @@ class BaseService:
 
         self.count_qualifiers_as_tag = False
         self.client = None
-        self.session: HTMLSession
+        self.session: Transport
         self.tag_limit: int
         self.censored_tags: list[str]
 
@@ -1,8 +1,7 @@
 from pybooru import Danbooru as PyDanbooru
 from pybooru.resources import SITE_LIST
-from requests_html import HTMLSession
-
 from danbooru.bot.animedatabase_utils.base_service import BaseService
+from danbooru.bot.animedatabase_utils.transport import Transport
 
 SITE_LIST["safebooru"] = {"url": "https://safebooru.donmai.us"}
 
@@ -39,13 +38,20 @@ class DanbooruService(BaseService):
 
     type = "danbooru"
 
-    def __init__(self, name: str, url: str, api: str = None, username: str = None, password: str = None) -> None:
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        api: str = None,
+        username: str = None,
+        password: str = None,
+        transport: Transport | None = None,
+    ) -> None:
         super(DanbooruService, self).__init__(name=name, url=url, api=api, username=username, password=password)
         self.user_level = None
-        self.session: HTMLSession
+        self.session = transport or Transport()
 
         self.init_client()
-        self.init_session()
 
     def init_client(self):
         if self.api:
@@ -54,6 +60,7 @@ class DanbooruService(BaseService):
             self.client = PyDanbooru(site_name=self.name, site_url=self.url, api_key=self.api, username=self.username)
         else:
             self.client = PyDanbooru(site_name=self.name, site_url=self.url)
+        self.init_session()
 
         self.user_level = self.get_user_level()
         self.tag_limit = self.LEVEL_RESTRICTIONS["tag_limit"][self.user_level]
@@ -63,7 +70,9 @@ class DanbooruService(BaseService):
             self.url = self.client.site_url.lstrip("/")
 
     def init_session(self):
-        self.session = HTMLSession()
+        """Let the API client send its requests through the shared transport as well"""
+        self.session.headers.update(self.client.client.headers)
+        self.client.client = self.session
 
     def get_user_level(self):
         user_level = 20
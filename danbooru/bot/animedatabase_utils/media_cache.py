@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import io
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+from typing import IO, Callable
+from uuid import uuid4
+
+
+class CachedFile(io.BufferedReader):
+    """Read only file of a cache entry, which keeps the entry pinned until it is closed"""
+
+    def __init__(self, path: Path, release: Callable[[], None]):
+        super(CachedFile, self).__init__(io.FileIO(path, "rb"))
+        self._release: Callable[[], None] | None = release
+
+    def close(self):
+        try:
+            super(CachedFile, self).close()
+        finally:
+            if release := self._release:
+                self._release = None
+                release()
+
+
+class MediaCache:
+    """Content addressed cache of downloaded and converted media on disk
+
+    Files are stored by the md5 of the post and a variant name (``original.zip``, ``mp4``, ``photo.jpg``, ...). The
+    least recently used files are deleted once the cache grows over ``max_size`` bytes, the newest file is always kept.
+    Files which are still open are pinned and not deleted, ffmpeg and vips read them by path. Concurrent requests for
+    the same file wait for the first one to create it instead of creating it again.
+    """
+
+    def __init__(self, folder: Path, max_size: int):
+        self.folder = folder
+        self.max_size = max_size
+        self.size = 0
+        self._entries: OrderedDict[Path, int] = OrderedDict()
+        self._flights: dict[Path, Future] = {}
+        # Open files per entry
+        self._pins: dict[Path, int] = {}
+        self._lock = Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self):
+        """Index the files already in the cache folder, oldest first, and remove unfinished ones"""
+        files = []
+        for path in self.folder.glob("*/*"):
+            if path.name.startswith("."):
+                path.unlink(missing_ok=True)
+                continue
+            files.append((path.stat(), path))
+
+        files.sort(key=lambda file: file[0].st_mtime)
+        with self._lock:
+            self._entries = OrderedDict((path, stat.st_size) for stat, path in files)
+            self.size = sum(self._entries.values())
+        self._evict()
+
+    def path(self, md5: str, variant: str) -> Path:
+        return self.folder / md5[:2] / f"{md5}.{variant}"
+
+    def get(self, md5: str, variant: str) -> Path | None:
+        path = self.path(md5, variant)
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.size -= self._entries.pop(path, 0)
+            return None
+        return path
+
+    def open_cached(self, md5: str, variant: str) -> IO[bytes] | None:
+        """Open a cached file if it exists, it is pinned until closed"""
+        if (path := self.get(md5, variant)) is None:
+            return None
+        return self._open(path)
+
+    def _open(self, path: Path) -> CachedFile | None:
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._pins[path] = self._pins.get(path, 0) + 1
+        try:
+            return CachedFile(path, lambda: self._unpin(path))
+        except FileNotFoundError:
+            self._unpin(path)
+            with self._lock:
+                self.size -= self._entries.pop(path, 0)
+            return None
+
+    def _unpin(self, path: Path):
+        with self._lock:
+            if (pins := self._pins.pop(path, 0) - 1) > 0:
+                self._pins[path] = pins
+        # Eviction may have waited for this file
+        self._evict()
+
+    def open(self, md5: str, variant: str, create: Callable[[Path], None]) -> IO[bytes]:
+        """Open a cached file, ``create`` writes it to the given path first if it isn't cached yet"""
+        path = self.path(md5, variant)
+        while True:
+            if (file := self.open_cached(md5, variant)) is not None:
+                return file
+
+            with self._lock:
+                if path in self._entries:
+                    # Another thread finished creating it since the lookup above
+                    continue
+                flight = self._flights.get(path)
+                if owner := flight is None:
+                    flight = self._flights[path] = Future()
+
+            if not owner:
+                # Someone else creates it right now, wait for them and use their result
+                flight.result()
+                continue
+            break
+
+        # Keep the extension, so tools guessing the format from it (e.g. vips) work on the unfinished file
+        temporary = path.with_name(f".{uuid4().hex}.{path.name}")
+        try:
+            path.parent.mkdir(exist_ok=True)
+            create(temporary)
+            os.replace(temporary, path)
+            size = path.stat().st_size
+            with self._lock:
+                self.size += size - self._entries.pop(path, 0)
+                self._entries[path] = size
+                self._pins[path] = self._pins.get(path, 0) + 1
+                self._flights.pop(path, None)
+            file = CachedFile(path, lambda: self._unpin(path))
+        except BaseException as error:
+            temporary.unlink(missing_ok=True)
+            with self._lock:
+                self._flights.pop(path, None)
+            flight.set_exception(error)
+            raise
+
+        flight.set_result(None)
+        self._evict()
+        return file
+
+    def discard(self, md5: str):
+        """Delete every variant of a file, e.g. after the post got a new file"""
+        prefix = f"{md5}."
+        with self._lock:
+            paths = [path for path in self._entries if path.name.startswith(prefix)]
+            for path in paths:
+                self.size -= self._entries.pop(path)
+        for path in paths:
+            path.unlink(missing_ok=True)
+        if paths:
+            self.logger.debug(f"Discarded {len(paths)} files of {md5}")
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self.size <= self.max_size:
+                    return
+                # Open files are read by path by other threads' conversions, they wait until they are closed
+                entries = list(self._entries)[:-1]
+                if (path := next((path for path in entries if path not in self._pins), None)) is None:
+                    return
+                self.size -= self._entries.pop(path)
+            path.unlink(missing_ok=True)
+            self.logger.debug(f"Evicted {path.name}")
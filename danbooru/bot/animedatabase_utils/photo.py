@@ -0,0 +1,78 @@
+import logging
+from pathlib import Path
+
+from pyvips import Image
+
+# Telegram rejects photos above this size or with a larger width + height
+SIZE_LIMIT = 10 * 1024**2
+DIMENSION_LIMIT = 10000
+
+MIN_QUALITY = 70
+MAX_QUALITY = 92
+# Upper bound of JPEG encodes to find a fitting quality, the encodes needed to scale down until it fits at all are
+# not counted
+MAX_ENCODES = 8
+
+# Telegram only takes JPEG thumbnails up to 320px per side and 200kB
+THUMB_SIZE = 320
+THUMB_QUALITY = 85
+
+logger = logging.getLogger("photo")
+
+
+def needs_shrink(size: int, width: int, height: int) -> bool:
+    return size > SIZE_LIMIT or width + height > DIMENSION_LIMIT
+
+
+def encode_photo(source: Path, output: Path, width: int, height: int):
+    """Write a JPEG within Telegram's photo limits, at the best quality that fits
+
+    The source is decoded directly at the target dimensions (shrink-on-load), so the full size bitmap is never held in
+    memory. Transparency is flattened onto white. Encodes at the highest quality first, then searches the quality
+    between ``MIN_QUALITY`` and ``MAX_QUALITY`` and only scales down further if even the lowest quality is too big.
+    The result always fits, only the quality search is limited to ``MAX_ENCODES``.
+    """
+    scale = min(1.0, DIMENSION_LIMIT / (width + height))
+    image = _load(source, int(width * scale), int(height * scale))
+
+    def encode(quality: int) -> bytes:
+        return image.jpegsave_buffer(Q=quality, optimize_coding=True, strip=True)
+
+    best = encode(MAX_QUALITY)
+    if len(best) > SIZE_LIMIT:
+        # Lowest quality known to fit and highest quality not known to fit (yet)
+        low, high = MIN_QUALITY, MAX_QUALITY
+        while len(best := encode(MIN_QUALITY)) > SIZE_LIMIT:
+            # The encoded size is roughly proportional to the pixel count
+            factor = (SIZE_LIMIT / len(best)) ** 0.5 * 0.95
+            image = image.resize(factor).copy_memory()
+            logger.info(f"Scaled down to {image.width}x{image.height} to fit {SIZE_LIMIT / 1024**2:.0f}MB")
+            # At the smaller scale even the highest quality may fit
+            high = MAX_QUALITY + 1
+
+        encodes = 2
+        while high - low > 2 and encodes < MAX_ENCODES:
+            encodes += 1
+            quality = (low + high) // 2
+            if len(data := encode(quality)) <= SIZE_LIMIT:
+                low, best = quality, data
+            else:
+                high = quality
+
+    output.write_bytes(best)
+
+
+def encode_thumbnail(source: Path, output: Path):
+    """Write a JPEG thumbnail of an image (the first frame of animated ones) in Telegram's thumbnail size"""
+    image = _load(source, THUMB_SIZE, THUMB_SIZE)
+    output.write_bytes(image.jpegsave_buffer(Q=THUMB_QUALITY, optimize_coding=True, strip=True))
+
+
+def _load(source: Path, width: int, height: int) -> Image:
+    image = Image.thumbnail(str(source), width, height=height, size="down")
+    if image.interpretation not in ("srgb", "b-w"):
+        image = image.colourspace("srgb")
+    if image.hasalpha():
+        image = image.flatten(background=[255] * (image.bands - 1))
+    # Kept in memory at the target size, so the search doesn't decode the source again for every encode
+    return image.copy_memory()
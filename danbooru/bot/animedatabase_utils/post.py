@@ -1,46 +1,84 @@
-from datetime import datetime
-from io import BytesIO
 import logging
+import os
 from pathlib import Path
+import struct
 from tempfile import NamedTemporaryFile
 from tempfile import TemporaryDirectory
-from typing import Iterable
-from zipfile import ZipFile
+from typing import IO, Callable, Iterable
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
 import ffmpeg
-import ffprobe
-from requests.exceptions import ConnectionError
 
+from danbooru.bot.animedatabase_utils import photo, video
 from danbooru.bot.animedatabase_utils.base_service import BaseService
+from danbooru.bot.animedatabase_utils.media_cache import MediaCache
+from danbooru.bot.animedatabase_utils.post_data import PostData
+from danbooru.bot.animedatabase_utils.probe import MediaInfo, probe_service
+from danbooru.bot.animedatabase_utils.transcoder import Transcoder
+from danbooru.bot.animedatabase_utils.video import VideoTooLarge
+
+DEFAULT_UGOIRA_DELAY = 66
+
+
+def _zip_data_offset(path: Path, info: ZipInfo) -> int:
+    """Offset of the data of a zip entry, right after its local header"""
+    with path.open("rb") as file:
+        file.seek(info.header_offset)
+        header = file.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def _concat_quote(url: str) -> str:
+    return "file '" + url.replace("'", "'\\''") + "'"
 
 
 class Post:
-    def __init__(self, post: dict, service: BaseService):
-        self.post = post
+    __slots__ = (
+        "post",
+        "service",
+        "cache",
+        "transcoder",
+        "priority",
+        "_file",
+        "_thumbnail",
+        "_fileext",
+        "_variant",
+        "_photo",
+        "_samples",
+        "_media_info",
+        "to_channel",
+        "targets",
+        "logger",
+    )
+
+    def __init__(
+        self,
+        post: PostData | dict,
+        service: BaseService,
+        cache: MediaCache | None = None,
+        transcoder: Transcoder | None = None,
+    ):
+        self.post = post if isinstance(post, PostData) else PostData.from_json(post)
         self.service = service
-        self._file: BytesIO = None  # type: ignore
-        self._thumbnail = None
+        self.cache = cache
+        self.transcoder = transcoder
+        # Lower values are converted first when waiting for the transcoder
+        self.priority = 0
+        self._file: IO[bytes] = None  # type: ignore
+        self._thumbnail: IO[bytes] | None = None
         self._fileext = None
-        self.videos: Iterable
-        self.audios: Iterable
-        self._updated_at = None
-        self._created_at = None
+        self._variant = ""
+        self._photo: IO[bytes] | None = None
+        self._samples: dict[str, IO[bytes]] = {}
+        self._media_info: MediaInfo | None = None
+        self.to_channel = True
+        self.targets: list[tuple[int, str | None]] | None = None
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def __getattr__(self, item):
-        return self.post[item]
-
-    @property
-    def updated_at(self) -> datetime:
-        if not self._updated_at:
-            self._updated_at = datetime.fromisoformat(self.post["updated_at"])
-        return self._updated_at
-
-    @property
-    def created_at(self) -> datetime:
-        if not self._created_at:
-            self._created_at = datetime.fromisoformat(self.post["created_at"])
-        return self._created_at
+        # Fields of the post data, e.g. id, rating, tags or created_at
+        return getattr(self.post, item)
 
     @property
     def rating_tag(self) -> str:
@@ -68,138 +106,341 @@ class Post:
 
     @property
     def has_audio(self) -> bool:
-        return bool(self.audio)
+        return self.media_info.has_audio
 
     @property
-    def video(self) -> ffprobe.ffprobe.FFStream | None:
-        self.prepare()
-        return next(iter(self.videos), None)
+    def duration(self) -> int | None:
+        return round(self.media_info.duration) if self.media_info.duration else None
 
     @property
-    def audio(self) -> ffprobe.ffprobe.FFStream | None:
-        self.prepare()
-        return next(iter(self.audios), None)
-
-    def prepare(self):
-        self._download_file()
-
-    def _get_video_probe(self) -> ffprobe.FFProbe:
-        with NamedTemporaryFile(mode="bw") as file:
-            file.write(self.file.read())
-            self.file.seek(0)
-            return ffprobe.FFProbe(file.name)
+    def media_info(self) -> MediaInfo:
+        """Duration, dimensions and audio of the file, probed only if the post data doesn't tell"""
+        if self._media_info is None:
+            self._media_info = self._media_info_from_post()
+        if self._media_info is None:
+            self._media_info = self._probe(self.file, self._variant)
+        return self._media_info
+
+    def _probe(self, file: IO[bytes], variant: str) -> MediaInfo:
+        md5 = self.post.md5
+        return probe_service.probe(Path(file.name), (md5, variant) if md5 else None)
+
+    def _media_info_from_post(self) -> MediaInfo | None:
+        width, height = self.post.image_width, self.post.image_height
+        if self.is_image:
+            return MediaInfo(width=width, height=height)
+
+        # Danbooru tags videos with an audio track as "sound" and knows the duration of animated media assets
+        duration = self.post.media_duration
+        if duration is None:
+            return None
+        has_audio = self.is_video and "sound" in self.post.meta_tags
+        return MediaInfo(duration=duration, width=width, height=height, has_audio=has_audio)
 
-    def _set_file_info(self):
-        probe = self._get_video_probe()
-        self.videos = probe.video
-        self.audios = probe.audio
+    @property
+    def needs_shrink(self) -> bool:
+        return self.is_image and photo.needs_shrink(self.post.file_size or 0, self.image_width, self.image_height)
 
-    def _download_thumbnail(self) -> BytesIO | None:
-        if self._thumbnail is None:
-            try:
-                self._thumbnail = BytesIO(self.service.session.get(self.post["preview_file_url"]).content)
-            except Exception as e:
-                print(f"Error while downloading preview of {self.id}")
-                print(e)
+    @property
+    def photo(self) -> IO[bytes]:
+        """The file to send as photo, shrunk to Telegram's photo limits if needed"""
+        if not self.needs_shrink:
+            return self.file
+        if self._photo is None:
+            self._photo = self.cached(
+                "photo.jpg", lambda output: photo.encode_photo(self.path, output, self.image_width, self.image_height)
+            )
+        return self._photo
+
+    def sample(self, quality: int) -> dict | None:
+        """Smallest pre-rendered Danbooru sample of an image whose longer side has at least ``quality`` pixels"""
+        if not quality or not self.is_image:
+            return None
+        samples = [
+            variant
+            for variant in self.post.variants
+            if variant.get("type") != "original"
+            and variant.get("file_ext") in ["jpg", "png"]
+            and max(variant.get("width", 0), variant.get("height", 0)) >= quality
+        ]
+        return min(samples, key=lambda variant: variant["width"] * variant["height"], default=None)
+
+    def photo_for(self, quality: int = 0) -> tuple[IO[bytes], str]:
+        """The file to send as photo to chats wanting at least ``quality`` pixels, together with its variant name
+
+        Only the needed sample is downloaded, the original isn't touched if a sample is good enough.
+        """
+        if not (sample := self.sample(quality)):
+            return self.photo, "original"
+
+        name = f'{sample["type"]}.{sample["file_ext"]}'
+        if name not in self._samples:
+            self._samples[name] = self.cached(name, lambda path: self._download_to(sample["url"], path))
+        return self._samples[name], sample["type"]
+
+    def prepare(self, qualities: Iterable[int] = (0,)):
+        """Download and convert everything needed to send the post at the given qualities"""
+        for quality in set(qualities):
+            if self.sample(quality):
+                self.photo_for(quality)
+                continue
 
-        return self._thumbnail
+            self._download_file()
+            # Probe and shrink right away if needed, while still in the background
+            self.media_info
+            if self.needs_shrink:
+                self.photo
+            if self.is_gif or self.file_extension == "mp4":
+                self.thumbnail
+
+    def close(self):
+        """Delete the downloaded and converted files, uploads already mapped from them stay valid"""
+        for file in (self._file, self._photo, self._thumbnail, *self._samples.values()):
+            if file is not None:
+                file.close()
+
+    def _temporary_file(self, suffix: str = "") -> IO[bytes]:
+        return NamedTemporaryFile(prefix=f"{self.id}-", suffix=suffix)
+
+    def cached(self, variant: str, create: Callable[[Path], None]) -> IO[bytes]:
+        """Open a variant of this post's file, ``create`` writes it to the given path if it isn't cached yet
+
+        Without a cache (or md5) the variant is created in a temporary file which is deleted once closed.
+        """
+        if self.cache is not None and (md5 := self.post.md5):
+            return self.cache.open(md5, variant, create)
+
+        file = self._temporary_file("." + variant.rsplit(".", 1)[-1])
+        try:
+            create(Path(file.name))
+        except BaseException:
+            file.close()
+            raise
+        return file
+
+    def _from_cache(self, variant: str) -> IO[bytes] | None:
+        if self.cache is None or not (md5 := self.post.md5):
+            return None
+        return self.cache.open_cached(md5, variant)
+
+    def _replace_file(self, file: IO[bytes], variant: str):
+        if self._file is not None and self._file is not file:
+            self._file.close()
+        self._file = file
+        self._variant = variant
 
     def _download_file(self):
         if self._file is None:
-            counter = 0
-            while True:
-                try:
-                    self._file = BytesIO(self.service.session.get(self.file_url).content)
-                    if self.file_extension == "webm":
-                        self._to_mp4()
-                    if self.file_extension == "zip":
-                        self._zip_to_video()
-                    break
-                except ConnectionError as error:
-                    counter += 1
-                    if counter == 3:
-                        raise error
-        self._set_file_info()
+            # Failed and broken off downloads are retried by the transport
+            if self.file_extension in ["webm", "mp4", "zip"] or (
+                self.is_gif and (self.post.file_size or 0) > video.GIF_TO_MP4_SIZE
+            ):
+                self._to_mp4()
+            else:
+                self._replace_file(self._original(), self._original_variant)
         return self._file
 
     @property
-    def thumbnail(self) -> BytesIO | None:
+    def _original_variant(self) -> str:
+        variant = "original" if self.file_url == self.post.file_url else "large"
+        return variant + Path(self.file_url).suffix
+
+    def _original(self) -> IO[bytes]:
+        return self.cached(self._original_variant, lambda path: self._download_to(self.file_url, path))
+
+    def _download_to(self, url: str, path: Path):
+        """Download in chunks to a file, so the content is never held in memory as a whole"""
+        self.service.session.download(url, path)
+
+    @property
+    def thumbnail(self) -> IO[bytes] | None:
+        """JPEG thumbnail made from the downloaded file, a frame of videos and the first frame of GIFs"""
         if self._thumbnail is None:
-            self._download_thumbnail()
+            try:
+                self._thumbnail = self.cached("thumb.jpg", self._create_thumbnail)
+            except Exception as error:
+                # Telegram makes its own thumbnail then
+                self.logger.exception(getattr(error, "stderr", error))
         return self._thumbnail
 
+    def _create_thumbnail(self, output: Path):
+        # Downloaded first, the extension changes when the file was converted to mp4
+        path = self.path
+        if self.file_extension == "mp4":
+            self._run_ffmpeg(video.thumbnail(path, output, self.media_info))
+        else:
+            photo.encode_thumbnail(path, output)
+
     @property
     def file_url(self) -> str:
         if (
-            self.post["file_url"].endswith(".zip")
-            and (url := self.post.get("large_file_url", "")).endswith((".mp4", ".webm"))
-            and not self.post.get("pixiv_ugoira_frame_data", {}).get("data", [])
+            (self.post.file_url or "").endswith(".zip")
+            and (url := self.post.large_file_url or "").endswith((".mp4", ".webm"))
+            and not self.post.ugoira_frames
         ):
             return url
-        return self.post["file_url"]
+        return self.post.file_url or ""
 
     @property
     def nice_file_url(self) -> str:
-        if self.post["file_url"].endswith(".zip") and (url := self.post.get("large_file_url", "")).endswith(
+        if (self.post.file_url or "").endswith(".zip") and (url := self.post.large_file_url or "").endswith(
             (".mp4", ".webm")
         ):
             return url
-        return self.post["file_url"]
+        return self.post.file_url or ""
 
     @property
-    def file(self) -> BytesIO:
+    def file(self) -> IO[bytes]:
         if self._file is None:
             self._download_file()
         return self._file  # type: ignore
 
+    @property
+    def path(self) -> Path:
+        return Path(self.file.name)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the prepared files and the thumbnail, the memory this post takes up once it is uploaded"""
+        size = 0
+        for file in (self._file, self._photo, self._thumbnail, *self._samples.values()):
+            if file is not None and not file.closed:
+                size += os.fstat(file.fileno()).st_size
+        return size
+
     @property
     def file_extension(self) -> str | None:
         if self._fileext is None:
             self._fileext = Path(self.file_url).suffix.replace(".", "")
         return self._fileext
 
-    def _get_delay(self) -> int:
+    def _ugoira_frames(self, archive: ZipFile) -> list[tuple[str, int]]:
+        """File name and delay in ms of every ugoira frame"""
+        if self.post.ugoira_frames:
+            return list(self.post.ugoira_frames)
+        return [(name, DEFAULT_UGOIRA_DELAY) for name in sorted(archive.namelist())]
+
+    def _to_mp4(self):
         try:
-            return self.pixiv_ugoira_frame_data["data"][0]["delay"]
-        except KeyError:
-            return 66
-
-    def _zip_to_video(self):
-        with TemporaryDirectory() as tempdir:
-            with ZipFile(self.file) as file:
-                file.extractall(tempdir)
-
-            image = next(Path(tempdir).glob("*"))
-            self._to_mp4(
-                tempdir + f"/*{image.suffix}",
-                {
-                    "pattern_type": "glob",
-                    "framerate": 1000 / self._get_delay(),
-                },
-            )
+            file, variant = self._video()
+        except (ffmpeg.Error, VideoTooLarge) as error:
+            # Sent as a document instead
+            self.logger.exception(getattr(error, "stderr", error))
+            self._replace_file(self._original(), self._original_variant)
+            return
 
-    def _to_mp4(self, input: str | Path = "pipe:", input_kwargs: dict[str, str | int | float] = {}):
-        self.logger.info(f'[{self.id}] Converting from "{self.file_extension}" to "mp4"')
-        self._file.seek(0)
+        self._replace_file(file, variant)
+        self._fileext = "mp4"
 
-        pipe_stdin = False
-        if input == "pipe:":
-            pipe_stdin = True
+    def _video(self) -> tuple[IO[bytes], str]:
+        """An mp4 Telegram can play and which fits into the upload limit, converting as little as possible
+
+        Compatible videos are used as they are or only remuxed, everything else is encoded. Videos above the upload
+        limit are encoded at the bitrate which makes them fit.
+        """
+        if (file := self._from_cache("small.mp4")) is not None:
+            self._media_info = self._probe(file, "small.mp4")
+            return file, "small.mp4"
+        if (file := self._from_cache("mp4")) is not None:
+            if os.fstat(file.fileno()).st_size <= video.UPLOAD_LIMIT:
+                return file, "mp4"
+            file.close()
+
+        if self.file_extension == "zip":
+            source, variant = self.cached("mp4", self._ugoira_to_mp4), "mp4"
+        else:
+            source, variant = self._original(), self._original_variant
+        info = self._probe(source, variant)
+        path = Path(source.name)
+        fits = os.fstat(source.fileno()).st_size <= video.UPLOAD_LIMIT
+        if fits and video.is_compatible(info) and variant.endswith("mp4"):
+            return source, variant
+
+        with source:
+            if fits and video.is_compatible(info):
+                self.logger.info(f'[{self.id}] Remuxing from "{self.file_extension}" to "mp4"')
+                return self.cached("mp4", lambda output: self._run_ffmpeg(video.remux(path, output))), "mp4"
+
+            if fits:
+                self.logger.info(f'[{self.id}] Converting from "{self.file_extension}" to "mp4"')
+                file = self.cached("mp4", lambda output: self._run_ffmpeg(video.encode(path, output, info)))
+                if os.fstat(file.fileno()).st_size <= video.UPLOAD_LIMIT:
+                    return file, "mp4"
+                file.close()
+
+            file = self.cached("small.mp4", lambda output: self._fit_upload_limit(path, info, output))
+        # It may have been scaled down, the post data only has the dimensions of the original
+        self._media_info = self._probe(file, "small.mp4")
+        return file, "small.mp4"
+
+    def _fit_upload_limit(self, source: Path, info: MediaInfo, output: Path):
+        bitrate = video.target_bitrate(info)
+        for _ in range(3):
+            height = None
+            if bitrate < video.LOW_BITRATE and (info.height or 0) > video.LOW_BITRATE_HEIGHT:
+                height = video.LOW_BITRATE_HEIGHT
+            self.logger.info(f"[{self.id}] Encoding at {bitrate // 1000}kbit/s to fit into the upload limit")
+            self._run_ffmpeg(video.encode(source, output, info, video_bitrate=bitrate, height=height))
+            if output.stat().st_size <= video.UPLOAD_LIMIT:
+                return
+            bitrate = int(bitrate * 0.85)
+        raise VideoTooLarge(f"Couldn't encode {self.id} below the upload limit")
+
+    def _ugoira_to_mp4(self, output: Path):
+        self.logger.info(f'[{self.id}] Converting from "{self.file_extension}" to "mp4"')
+        with self._original() as original:
+            self._zip_to_video(Path(original.name), output)
+
+    def _zip_to_video(self, source: Path, output: Path):
+        """Encode an ugoira with the delay of every single frame
+
+        ffmpeg's concat demuxer reads the frames right out of the zip (ugoira zips are stored uncompressed) and shows
+        each for its own duration. Only compressed frames, which can't be read in place, are extracted.
+        """
+        with ZipFile(source) as archive, TemporaryDirectory() as tempdir:
+            lines = ["ffconcat version 1.0"]
+            for name, delay in self._ugoira_frames(archive):
+                info = archive.getinfo(name)
+                if info.compress_type == ZIP_STORED:
+                    start = _zip_data_offset(source, info)
+                    url = f"subfile,,start,{start},end,{start + info.file_size},,:{source}"
+                else:
+                    url = archive.extract(info, tempdir)
+                lines += [_concat_quote(url), f"duration {delay / 1000:.3f}"]
+            # The duration of the last entry is only used when another entry follows
+            lines.append(lines[-2])
+
+            playlist = Path(tempdir) / "frames.ffconcat"
+            playlist.write_text("\n".join(lines) + "\n")
+            self._ffmpeg_to_mp4(
+                playlist,
+                output,
+                {"format": "concat", "safe": 0, "protocol_whitelist": "file,subfile"},
+                {"vsync": "vfr"},
+            )
 
-        proc = (
-            ffmpeg.input(input, **input_kwargs)
-            .output("pipe:", format="mp4", movflags="frag_keyframe+empty_moov", vf="pad=ceil(iw/2)*2:ceil(ih/2)*2")
+    def _ffmpeg_to_mp4(
+        self,
+        input: str | Path,
+        output: Path,
+        input_kwargs: dict[str, str | int | float] = {},
+        output_kwargs: dict[str, str | int | float] = {},
+    ):
+        # ffmpeg reads from and writes to disk, the output is seekable so the index can go to the front
+        self._run_ffmpeg(
+            ffmpeg.input(str(input), **input_kwargs)
+            .output(
+                str(output),
+                format="mp4",
+                movflags="+faststart",
+                vf="pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                **output_kwargs,
+            )
             .global_args("-hide_banner")
-            .run_async(pipe_stdin=pipe_stdin, pipe_stdout=True, pipe_stderr=True)
         )
-        out, err = proc.communicate(input=self._file.read())
-
-        if not out:
-            self.logger.exception(err)
-            return
 
-        self._file = BytesIO()
-        self._file.write(out)
-        self._file.seek(0)
-
-        self._fileext = "mp4"
+    def _run_ffmpeg(self, stream: ffmpeg.nodes.OutputStream):
+        if self.transcoder:
+            self.transcoder.run(stream, priority=self.priority)
+        else:
+            stream.overwrite_output().run(capture_stdout=True, capture_stderr=True)
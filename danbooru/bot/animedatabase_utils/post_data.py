@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+from datetime import datetime
+import sys
+from typing import Any
+
+# The only fields of a post the bot uses, passed as ``only`` so Danbooru leaves out everything else
+POST_FIELDS = (
+    "id",
+    "md5",
+    "rating",
+    "score",
+    "fav_count",
+    "tag_count",
+    "created_at",
+    "updated_at",
+    "file_ext",
+    "file_size",
+    "image_width",
+    "image_height",
+    "file_url",
+    "large_file_url",
+    "source",
+    "pixiv_id",
+    "is_deleted",
+    "is_banned",
+    "is_pending",
+    "is_flagged",
+    "tag_string",
+    "tag_string_artist",
+    "tag_string_character",
+    "tag_string_meta",
+    "media_asset[duration,variants]",
+    "pixiv_ugoira_frame_data[data]",
+)
+ONLY = ",".join(POST_FIELDS)
+
+
+def _tags(value: str | None) -> tuple[str, ...]:
+    # The same tags show up in thousands of posts, interned they are stored once
+    return tuple(sys.intern(tag) for tag in (value or "").split())
+
+
+def _timestamp(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value else None
+
+
+@dataclass(frozen=True, slots=True)
+class PostData:
+    """The fields of a Danbooru post the bot uses, with tags, timestamps and media info parsed once"""
+
+    id: int
+    md5: str | None = None
+    rating: str | None = None
+    score: int | None = None
+    fav_count: int | None = None
+    tag_count: int | None = None
+    created_at: datetime | None = None
+    updated_at: datetime | None = None
+    file_ext: str | None = None
+    file_size: int | None = None
+    image_width: int | None = None
+    image_height: int | None = None
+    file_url: str | None = None
+    large_file_url: str | None = None
+    source: str | None = None
+    pixiv_id: int | None = None
+    is_deleted: bool = False
+    is_banned: bool = False
+    is_pending: bool = False
+    is_flagged: bool = False
+    tags: frozenset[str] = frozenset()
+    artist_tags: tuple[str, ...] = ()
+    character_tags: tuple[str, ...] = ()
+    meta_tags: frozenset[str] = frozenset()
+    # Seconds, only known for animated media assets
+    media_duration: float | None = None
+    # Pre-rendered samples of the media asset, each with type, url, width, height and file_ext
+    variants: tuple[dict, ...] = ()
+    # File name and delay in ms of every ugoira frame
+    ugoira_frames: tuple[tuple[str, int], ...] = ()
+
+    @classmethod
+    def from_json(cls, post: dict) -> "PostData":
+        media_asset = post.get("media_asset") or {}
+        frames = (post.get("pixiv_ugoira_frame_data") or {}).get("data") or []
+        return cls(
+            id=post["id"],
+            md5=post.get("md5"),
+            rating=post.get("rating"),
+            score=post.get("score"),
+            fav_count=post.get("fav_count"),
+            tag_count=post.get("tag_count"),
+            created_at=_timestamp(post.get("created_at")),
+            updated_at=_timestamp(post.get("updated_at")),
+            file_ext=post.get("file_ext"),
+            file_size=post.get("file_size"),
+            image_width=post.get("image_width"),
+            image_height=post.get("image_height"),
+            file_url=post.get("file_url"),
+            large_file_url=post.get("large_file_url"),
+            source=post.get("source"),
+            pixiv_id=post.get("pixiv_id"),
+            is_deleted=bool(post.get("is_deleted")),
+            is_banned=bool(post.get("is_banned")),
+            is_pending=bool(post.get("is_pending")),
+            is_flagged=bool(post.get("is_flagged")),
+            tags=frozenset(_tags(post.get("tag_string"))),
+            artist_tags=_tags(post.get("tag_string_artist")),
+            character_tags=_tags(post.get("tag_string_character")),
+            meta_tags=frozenset(_tags(post.get("tag_string_meta"))),
+            media_duration=media_asset.get("duration"),
+            variants=tuple(media_asset.get("variants") or ()),
+            ugoira_frames=tuple((frame["file"], frame["delay"]) for frame in frames),
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Dict like access to a field by its name in the post JSON, e.g. for the query engine"""
+        value = getattr(self, key, None)
+        return default if value is None else value
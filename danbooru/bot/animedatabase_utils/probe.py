@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+from threading import Lock
+from typing import Hashable
+
+import ffmpeg
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    duration: float | None = None
+    width: int | None = None
+    height: int | None = None
+    has_audio: bool = False
+    video_codec: str | None = None
+    audio_codec: str | None = None
+
+    @classmethod
+    def from_probe(cls, probe: dict) -> "MediaInfo":
+        streams = probe.get("streams", [])
+        video = next((stream for stream in streams if stream.get("codec_type") == "video"), {})
+        audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), {})
+        duration = probe.get("format", {}).get("duration") or video.get("duration")
+        return cls(
+            duration=float(duration) if duration else None,
+            width=video.get("width"),
+            height=video.get("height"),
+            has_audio=bool(audio),
+            video_codec=video.get("codec_name"),
+            audio_codec=audio.get("codec_name"),
+        )
+
+
+class ProbeService:
+    """ffprobe results memoized by the md5 of the post and the variant of its file
+
+    ffprobe reads the downloaded file from disk, so probing never copies it. The same file (e.g. sent again from the
+    outbox or matched by several feeds) is only probed once.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._results: OrderedDict[Hashable, MediaInfo] = OrderedDict()
+        self._lock = Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def probe(self, path: Path, key: Hashable | None = None) -> MediaInfo:
+        """Probe a file, ``key`` identifies its content for memoization (e.g. md5 and variant)"""
+        if key:
+            with self._lock:
+                if (info := self._results.get(key)) is not None:
+                    self._results.move_to_end(key)
+                    return info
+
+        self.logger.debug(f"Probing {path.name}")
+        info = MediaInfo.from_probe(ffmpeg.probe(str(path)))
+
+        if key:
+            with self._lock:
+                self._results[key] = info
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+        return info
+
+
+probe_service = ProbeService()
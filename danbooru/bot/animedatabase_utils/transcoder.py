@@ -0,0 +1,72 @@
+from heapq import heappop, heappush
+from itertools import count
+import logging
+import subprocess
+from threading import Condition
+
+import ffmpeg
+
+
+class TranscodeTimeout(ffmpeg.Error):
+    pass
+
+
+class Transcoder:
+    """Runs ffmpeg jobs on a limited number of workers with a deadline per job
+
+    Every job is its own ffmpeg process, so conversions use all cores while the calling threads only wait. Jobs waiting
+    for a free worker start in order of their ``priority`` (lowest first), so the post delivery waits for next gets its
+    conversion first. Jobs running longer than ``timeout`` seconds are killed.
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 300):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._slots = 0
+        self._waiting: list[tuple[float, int]] = []
+        self._tickets = count()
+        self._condition = Condition()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def _acquire(self, priority: float):
+        ticket = (priority, next(self._tickets))
+        with self._condition:
+            heappush(self._waiting, ticket)
+            self._condition.wait_for(lambda: self._slots < self.workers and self._waiting[0] == ticket)
+            heappop(self._waiting)
+            self._slots += 1
+            # The next job in line may fit as well
+            self._condition.notify_all()
+
+    def _release(self):
+        with self._condition:
+            self._slots -= 1
+            self._condition.notify_all()
+
+    def run(self, stream: ffmpeg.nodes.OutputStream, priority: float = 0, timeout: float | None = None):
+        """Run an ffmpeg-python stream once a worker is free
+
+        Raises:
+            ffmpeg.Error: If ffmpeg failed
+            TranscodeTimeout: If ffmpeg didn't finish within the deadline and was killed
+        """
+        timeout = timeout or self.timeout
+        self._acquire(priority)
+        try:
+            process = stream.overwrite_output().run_async(pipe_stdout=True, pipe_stderr=True)
+            try:
+                out, err = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.logger.warning(f"Killing ffmpeg after {timeout}s")
+                process.kill()
+                out, err = process.communicate()
+                raise TranscodeTimeout("ffmpeg", out, err)
+
+            if process.returncode:
+                raise ffmpeg.Error("ffmpeg", out, err)
+        finally:
+            self._release()
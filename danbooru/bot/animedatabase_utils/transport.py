@@ -0,0 +1,160 @@
+from email.utils import parsedate_to_datetime
+from itertools import count
+import logging
+from pathlib import Path
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep, time
+from typing import Callable
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from danbooru.bot.ratelimit import TokenBucket
+
+CHUNK_SIZE = 1024**2
+RETRY_STATUS = {429, 503}
+RETRY_EXCEPTIONS = (ConnectionError, ChunkedEncodingError, Timeout)
+
+# Called after every request with the endpoint class, method, url, status code (None on errors) and the seconds
+# until the response arrived
+TimingHook = Callable[[str, str, str, int | None, float], None]
+
+
+def retry_after(response: Response) -> float | None:
+    """Seconds to wait according to the ``Retry-After`` header, which holds either seconds or an HTTP date"""
+    if not (value := response.headers.get("Retry-After")):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Transport(Session):
+    """The one HTTP session every Danbooru API call and download goes through
+
+    Keeps up to ``pool_size`` connections per host alive. Requests are paced by a :class:`TokenBucket` per endpoint
+    class (``api`` for JSON calls, ``media`` for everything else), answers with 429 or 503 and connection errors are
+    retried with exponential backoff (or after ``Retry-After``) and slow the endpoint class down. Every request is
+    reported to the ``timing_hooks``.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        api_rate: float = 10,
+        media_rate: float = 20,
+        max_retries: int = 5,
+        backoff: float = 1,
+        max_backoff: float = 60,
+        timeout: float | tuple[float, float] = (10, 60),
+    ):
+        super(Transport, self).__init__()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+        self.buckets = {
+            "api": TokenBucket(api_rate, capacity=api_rate),
+            "media": TokenBucket(media_rate, capacity=media_rate),
+        }
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.timing_hooks: list[TimingHook] = [self._log_timing]
+        # Request count, seconds and failures per endpoint class
+        self._stats: dict[str, list] = {}
+        self._stats_lock = Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """Endpoint class of a url, each class has its own rate limit"""
+        return "api" if url.split("?", 1)[0].endswith(".json") else "media"
+
+    def _delay(self, attempt: int, response: Response | None = None) -> float:
+        if response is not None and (delay := retry_after(response)) is not None:
+            return min(delay, self.max_backoff)
+        # Jittered, so parallel requests don't all come back at the same time
+        return min(self.backoff * 2**attempt, self.max_backoff) * uniform(0.5, 1)
+
+    def request(self, method: str, url: str, *args, **kwargs) -> Response:  # type: ignore[override]
+        """Send a request once its endpoint class allows it, retrying rate limited and failed requests"""
+        endpoint = self.endpoint(str(url))
+        bucket = self.buckets[endpoint]
+        kwargs.setdefault("timeout", self.timeout)
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            start = monotonic()
+            try:
+                response = super(Transport, self).request(method, url, *args, **kwargs)
+            except RETRY_EXCEPTIONS as error:
+                self._report(endpoint, method, url, None, monotonic() - start)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._delay(attempt)
+                self.logger.warning(f"{method} {url} failed ({error.__class__.__name__}), retrying in {delay:.1f}s")
+                bucket.penalize(delay)
+                attempt += 1
+                continue
+
+            self._report(endpoint, method, url, response.status_code, monotonic() - start)
+            if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                if response.status_code not in RETRY_STATUS:
+                    bucket.reward()
+                return response
+
+            delay = self._delay(attempt, response)
+            self.logger.warning(f"{method} {url} answered {response.status_code}, retrying in {delay:.1f}s")
+            response.close()
+            bucket.penalize(delay)
+            attempt += 1
+
+    def download(self, url: str, path: Path, chunk_size: int = CHUNK_SIZE):
+        """Stream a file to ``path`` in chunks, starting over if the connection breaks off midway"""
+        for attempt in count():
+            with self.get(url, stream=True) as response:
+                response.raise_for_status()
+                try:
+                    with path.open("wb") as file:
+                        for chunk in response.iter_content(chunk_size):
+                            file.write(chunk)
+                    return
+                except RETRY_EXCEPTIONS as error:
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = self._delay(attempt)
+                    self.logger.warning(f"Download of {url} broke off ({error!r}), retrying in {delay:.1f}s")
+            sleep(delay)
+
+    def _report(self, endpoint: str, method: str, url: str, status: int | None, seconds: float):
+        with self._stats_lock:
+            stats = self._stats.setdefault(endpoint, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += status is None or status >= 400
+        for hook in self.timing_hooks:
+            try:
+                hook(endpoint, method, url, status, seconds)
+            except Exception as error:
+                self.logger.exception(error)
+
+    def _log_timing(self, endpoint: str, method: str, url: str, status: int | None, seconds: float):
+        self.logger.debug(f"{method} {url} [{endpoint}] -> {status} in {seconds * 1000:.0f}ms")
+
+    def summary(self) -> str:
+        """Request count, average duration and failures per endpoint class"""
+        with self._stats_lock:
+            return "\n".join(
+                f"{endpoint}: {requests} requests, {total / requests * 1000:.0f}ms avg, {failed} failed"
+                for endpoint, (requests, total, failed) in sorted(self._stats.items())
+            )
@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import ffmpeg
+
+from danbooru.bot.animedatabase_utils.photo import THUMB_SIZE
+from danbooru.bot.animedatabase_utils.probe import MediaInfo
+
+# Telegram bots can't upload files bigger than this
+UPLOAD_LIMIT = 50 * 1024**2
+# GIFs bigger than this are sent as (much smaller) mp4 animations
+GIF_TO_MP4_SIZE = 1024**2
+
+COMPATIBLE_VIDEO_CODECS = {"h264"}
+COMPATIBLE_AUDIO_CODECS = {"aac"}
+AUDIO_BITRATE = 128_000
+# Below this video bitrate (bit/s) the resolution is lowered as well, below the minimum the video is given up on
+LOW_BITRATE = 1_000_000
+MIN_BITRATE = 100_000
+LOW_BITRATE_HEIGHT = 480
+# Thumbnails show the frame at this point, or halfway through shorter videos
+THUMB_TIME = 1.0
+
+
+class VideoTooLarge(ValueError):
+    pass
+
+
+def is_compatible(info: MediaInfo) -> bool:
+    """Whether the streams can be put into an mp4 for Telegram as they are"""
+    return info.video_codec in COMPATIBLE_VIDEO_CODECS and (
+        not info.has_audio or info.audio_codec in COMPATIBLE_AUDIO_CODECS
+    )
+
+
+def remux(input: Path, output: Path) -> ffmpeg.nodes.OutputStream:
+    """Copy the streams into an mp4 with the index at the front, nothing is encoded"""
+    return (
+        ffmpeg.input(str(input))
+        .output(str(output), format="mp4", c="copy", movflags="+faststart")
+        .global_args("-hide_banner")
+    )
+
+
+def encode(
+    input: Path,
+    output: Path,
+    info: MediaInfo,
+    video_bitrate: int | None = None,
+    height: int | None = None,
+) -> ffmpeg.nodes.OutputStream:
+    """Encode to H.264/AAC, at constant quality or at ``video_bitrate`` for a predictable size"""
+    kwargs: dict = {
+        "format": "mp4",
+        "movflags": "+faststart",
+        "vcodec": "libx264",
+        "preset": "veryfast",
+        "pix_fmt": "yuv420p",
+        "vf": f"scale=-2:{height}" if height else "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+    }
+    if video_bitrate:
+        kwargs.update({"b:v": video_bitrate, "maxrate": video_bitrate, "bufsize": video_bitrate * 2})
+    else:
+        kwargs["crf"] = 23
+    if info.has_audio:
+        kwargs.update({"acodec": "aac", "b:a": AUDIO_BITRATE})
+    else:
+        kwargs["an"] = None
+    return ffmpeg.input(str(input)).output(str(output), **kwargs).global_args("-hide_banner")
+
+
+def target_bitrate(info: MediaInfo, limit: int = UPLOAD_LIMIT) -> int:
+    """Video bitrate (bit/s) which keeps the whole video below ``limit`` bytes, leaving room for the container"""
+    if not info.duration:
+        raise VideoTooLarge("Unknown duration, can't calculate a bitrate")
+    bitrate = int(limit * 8 * 0.95 / info.duration) - (AUDIO_BITRATE if info.has_audio else 0)
+    if bitrate < MIN_BITRATE:
+        raise VideoTooLarge(f"A {info.duration:.0f}s video doesn't fit into {limit / 1024**2:.0f}MB")
+    return bitrate
+
+
+def thumbnail(input: Path, output: Path, info: MediaInfo) -> ffmpeg.nodes.OutputStream:
+    """Grab a single frame as JPEG thumbnail in Telegram's thumbnail size"""
+    position = min(THUMB_TIME, info.duration / 2) if info.duration else 0
+    return (
+        ffmpeg.input(str(input), ss=position)
+        .output(
+            str(output),
+            format="image2",
+            vcodec="mjpeg",
+            vframes=1,
+            vf=f"scale={THUMB_SIZE}:{THUMB_SIZE}:force_original_aspect_ratio=decrease",
+            **{"q:v": 4},
+        )
+        .global_args("-hide_banner")
+    )
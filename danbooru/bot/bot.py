@@ -6,18 +6,11 @@ import types
 from typing import Callable, Type
 
 from telegram import Bot, Update, User
-from telegram.ext import (
-    CallbackContext,
-    CommandHandler,
-    Filters,
-    Handler,
-    MessageHandler,
-    Updater,
-    messagequeue,
-)
+from telegram.ext import CallbackContext, CommandHandler, Filters, Handler, MessageHandler, Updater
 from telegram.utils.request import Request
 
-from .settings import ADMINS, LOG_LEVEL, MODE, TELEGRAM_API_TOKEN
+from .ratelimit import RateLimiter, ratelimited
+from .settings import ADMINS, FANOUT_WORKERS, GLOBAL_RATE, GROUP_RATE, LOG_LEVEL, MODE, TELEGRAM_API_TOKEN
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=LOG_LEVEL)
 
@@ -27,25 +20,17 @@ danbooru_bot: "DanbooruBot" = None  # type: ignore
 def decorate_all_senders(cls):
     for attr in dir(cls):
         if attr.startswith("send_") and isinstance(method := getattr(cls, attr), types.FunctionType):
-            setattr(cls, attr, messagequeue.queuedmessage(method))
+            setattr(cls, attr, ratelimited(method))
     return cls
 
 
 @decorate_all_senders
-class MQBot(Bot):
-    """subclass of Bot which delegates send method handling to MQ"""
+class RateLimitedBot(Bot):
+    """subclass of Bot which sends through a per chat and global rate limiter"""
 
-    def __init__(self, *args, is_queued_def=False, mqueue=None, **kwargs):
-        super(MQBot, self).__init__(*args, **kwargs)
-        # below 2 attributes should be provided for decorator usage
-        self._is_messages_queued_default = is_queued_def
-        self._msg_queue = mqueue or messagequeue.MessageQueue()
-
-    def __del__(self):
-        try:
-            self._msg_queue.stop()
-        except:
-            pass
+    def __init__(self, *args, rate_limiter: RateLimiter | None = None, **kwargs):
+        super(RateLimitedBot, self).__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter or RateLimiter()
 
 
 class DanbooruBot:
@@ -59,9 +44,9 @@ class DanbooruBot:
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def start(self):
-        queue = messagequeue.MessageQueue(all_burst_limit=2, all_time_limit_ms=6000)
-        request = Request(con_pool_size=8)
-        bot = MQBot(self.token, request=request, mqueue=queue)
+        rate_limiter = RateLimiter(global_rate=GLOBAL_RATE, group_rate=GROUP_RATE / 60)
+        request = Request(con_pool_size=FANOUT_WORKERS + 4)
+        bot = RateLimitedBot(self.token, request=request, rate_limiter=rate_limiter)
 
         self.updater = Updater(bot=bot)
 
@@ -1,7 +1,10 @@
-from datetime import timedelta
-from io import BytesIO
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import count
 import json
 import logging
+import os
 from random import sample
 import re
 from time import time
@@ -9,58 +12,36 @@ from typing import Any, Callable, Dict, Iterable
 from urllib.parse import urlparse
 
 from emoji import emojize
-from pyvips import Image
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext, MessageHandler
-from telegram.ext.utils.promise import Promise
-from telegram.files.inputfile import InputFile
 from telegram.parsemode import ParseMode
 from timeout_decorator import TimeoutError
 from yarl import URL
 
 from danbooru.bot import settings
 from danbooru.bot.animedatabase_utils.danbooru_service import DanbooruService
+from danbooru.bot.animedatabase_utils.media_cache import MediaCache
 from danbooru.bot.animedatabase_utils.post import Post
+from danbooru.bot.animedatabase_utils.post_data import PostData
+from danbooru.bot.animedatabase_utils.transcoder import Transcoder
+from danbooru.bot.animedatabase_utils.transport import Transport
 from danbooru.bot.bot import danbooru_bot
-
-
-
-
-
-class Tracker(list):
-    _tracker_file = settings.CONFIG_FOLDER / "tracker.txt"
-
-    def __init__(self):
-        self._tracker_file.touch(exist_ok=True)
-        self.load()
-
-    def load(self):
-        content = self._tracker_file.read_text()
-        ids = map(int, content.strip().split())
-        super(Tracker, self).__init__(ids)
-
-    def not_implemented(self):
-        raise NotImplementedError
-
-    clear = remove = insert = pop = not_implemented
-
-    def append(self, item):
-        self.extend([item])
-
-    def extend(self, items):
-        super(Tracker, self).extend(items)
-        if len(self) > 100:
-            items = self[len(self) - 100 :]
-            super(Tracker, self).__init__(items)
-        self._tracker_file.write_text(" ".join(map(str, self)))
+from danbooru.bot.feed import ChangeFeed, IdLookup, UnionFeed, fetch_after
+from danbooru.bot.memory import MemoryBudget
+from danbooru.bot.outbox import Outbox
+from danbooru.bot.pipeline import prefetch
+from danbooru.bot.query import compile_query
+from danbooru.bot.scheduler import AdaptiveInterval
+from danbooru.bot.store import Store
+from danbooru.bot.subscriptions import SubscriptionIndex
+from danbooru.bot.tracker import Tracker
+from danbooru.bot.upload import MappedInputFile
 
 
 class Command:
     is_refreshing = False
     is_manual_refresh = False
-    tracker = Tracker()
-    _sub_config = settings.CONFIG_FOLDER / "sub_config.json"
-    _prepared_post_kwargs = {}
     SAFE_CONFIG_KEYS = {
         "artist",
         "buttons",
@@ -75,22 +56,67 @@ class Command:
         "force_file",
         "explicit_file",
         "questionable_file",
+        "quality",
         "debug",
     }
     UNSAFE_CONFIG_KEYS = {"subs"}
+    FILE_KINDS = ("photo", "animation", "video", "document")
 
     def __init__(self):
-        self.service = DanbooruService(**settings.SERVICE)
-        self.last_post_file = settings.CONFIG_FOLDER / "last_post.txt"
-        self._last_post_id = None
+        transport = Transport(
+            pool_size=settings.HTTP_POOL_SIZE,
+            api_rate=settings.DANBOORU_RATE,
+            media_rate=settings.DOWNLOAD_RATE,
+            max_retries=settings.HTTP_RETRIES,
+        )
+        self.service = DanbooruService(**settings.SERVICE, transport=transport)
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        # Fail early on syntax errors in the configured filter
+        compile_query(settings.POST_TAG_FILTER)  # type: ignore
+
+        self.store = Store(settings.CONFIG_FOLDER / "state.sqlite")
+        self.store.import_files(settings.CONFIG_FOLDER)
+        self.tracker = Tracker(self.store, settings.TRACKER_SIZE)
+        if not settings.EDIT_TRACK and self.store.get("edit_track_start") is not None:
+            # Posts handled while EDIT_TRACK is off may not be tracked, so it starts over once enabled again
+            self.store.set("edit_track_start", None)
+        self.outbox = Outbox(self.store, max_attempts=settings.RETRY_ATTEMPTS)
+        self.fanout = ThreadPoolExecutor(max_workers=settings.FANOUT_WORKERS, thread_name_prefix="fanout")
+        self._prepared_post_kwargs: dict[int, dict[int, tuple[Callable, dict]]] = {}
+        self.memory = MemoryBudget(settings.MEMORY_BUDGET * 1024**2, on_evict=self._drop_prepared)
+        self.media_cache = None
+        if settings.MEDIA_CACHE_SIZE:
+            self.media_cache = MediaCache(settings.CONFIG_FOLDER / "media", settings.MEDIA_CACHE_SIZE * 1024**2)
+        self.transcoder = Transcoder(workers=settings.TRANSCODE_WORKERS, timeout=settings.TRANSCODE_TIMEOUT)
+        self._post_sequence = count()
+        # Posts still in their grace period are prepared in the background, by id with the md5 of their file and the
+        # future of the preparation
+        self.warmer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="warm")
+        self._warming: dict[int, tuple[str, Future]] = {}
+        # Highest post id the feed looked at in the current refresh, including skipped and filtered posts. The
+        # cursors are moved there once every post before it was handled.
+        self._scanned: int | None = None
+        self.subscriptions = SubscriptionIndex(self.config)
+        self.feed = UnionFeed(
+            self.service.client,
+            self.store,
+            concurrency=settings.QUERY_CONCURRENCY,
+            max_pages=settings.MAX_PAGES,
+        )
+        self.id_lookup = IdLookup(self.service.client)
+        self.change_feed = ChangeFeed(self.service.client, self.store, max_pages=settings.MAX_PAGES)
+
         self.job = None
+        self.poll = AdaptiveInterval(
+            min_interval=settings.RELOAD_MIN_SECONDS,
+            max_interval=settings.RELOAD_MAX_SECONDS,
+            initial=settings.RELOAD_INTEVAL * 60,
+            target_posts=settings.RELOAD_TARGET,
+        )
         if settings.AUTO_START:
             self.start_scheduler()
 
-        self._sub_config.touch()
-
         danbooru_bot.add_command(
             name="config", func=self.change_config_command_wrapper, admin=False, pass_args=True, run_async=True
         )
@@ -108,103 +134,189 @@ class Command:
         danbooru_bot.add_command(name="start", func=self.start_command, run_async=True)
         danbooru_bot.add_command(name="cancel", func=self.cancel_command, run_async=True)
         danbooru_bot.add_command(name="stop", func=self.stop_command, run_async=True)
+        danbooru_bot.add_command(name="memory", func=self.memory_command, run_async=True)
         danbooru_bot.add_command(name="ipdb", func=self.ipdb, run_async=True, admin=True)
         danbooru_bot.add_command(name="pdb", func=self.pdb, run_async=True, admin=True)
         danbooru_bot.add_command(MessageHandler, func=self.messagehandler, filters=None, run_async=True)
 
     @property
     def last_post_id(self) -> int:
-        if not self._last_post_id:
-            try:
-                self._last_post_id = int(self.last_post_file.read_text().strip())
-            except FileNotFoundError:
-                latest_post = next(iter(self.service.client.post_list(limit=1)), None)
-                if latest_post is None:
-                    raise ValueError("You have to set a post id in the last_post.txt")
-                else:
-                    self._last_post_id = latest_post["id"]
-                    self.last_post_file.write_text(str(self._last_post_id))
-        return self._last_post_id
+        last_post_id = self.store.get("last_post_id")
+        if last_post_id is None:
+            latest_post = next(iter(self.service.client.post_list(limit=1, only="id")), None)
+            if latest_post is None:
+                raise ValueError("Could not determine the latest post on Danbooru")
+            last_post_id = self.last_post_id = latest_post["id"]
+        return last_post_id
 
     @last_post_id.setter
     def last_post_id(self, value: int):
-        self._last_post_id = value
-        with open(self.last_post_file, mode="w") as file_:
-            file_.write(str(self._last_post_id))
+        self.store.set("last_post_id", value)
 
-    def is_ok(self, post: Post) -> bool:
-        try:
-            if post.is_banned or post.is_deleted:
-                return False
-        except KeyError:
-            pass
+    def new_post(self, post_data: PostData) -> Post:
+        post = Post(post_data, self.service, cache=self.media_cache, transcoder=self.transcoder)
+        # Posts are sent in the order they are created, so earlier ones get their conversions first
+        post.priority = next(self._post_sequence)
+        return post
 
-        tags = set(post.tag_string.split(" "))
-        white_list = set(filter(lambda tag: not tag.startswith("-"), settings.POST_TAG_FILTER))  # type: ignore
-        black_list = set(map(lambda tag: tag.strip("-"), settings.POST_TAG_FILTER - white_list))  # type: ignore
+    def is_ok(self, post: Post) -> bool:
+        # Banned posts and those restricted to higher account levels come without their file
+        if post.is_banned or post.is_deleted or not post.file_url:
+            return False
 
-        if not tags & black_list and tags & white_list == white_list:
-            return True
-        return False
+        return compile_query(settings.POST_TAG_FILTER).matches(post.post)  # type: ignore
 
     def _get_posts_by_number_only(self):
-        posts = self.service.client.post_list(limit=1)
+        last_post_id = self.last_post_id
+        posts, complete = fetch_after(self.service.client, "", last_post_id, max_pages=settings.MAX_PAGES)
+        self.poll.observe((post.id for post in posts), complete)
         if not posts:
             return
+        if not complete:
+            self.logger.info("More posts available than fetched, continuing next refresh")
+
+        latest_post_id = posts[-1].id
+        id_post_map = {post.id: post for post in posts}
+        missing = [post_id for post_id in range(last_post_id + 1, latest_post_id) if post_id not in id_post_map]
+        if missing:
+            id_post_map.update(self.id_lookup.fetch(missing))
+
+        for post_id in range(last_post_id + 1, latest_post_id + 1):
+            post_data = id_post_map.get(post_id)
+            if post_data is None:
+                self.logger.debug(f"Skip restricted post {post_id}")
+                continue
 
-        latest_post_id = posts[0]["id"]
+            post = self.new_post(post_data)
+            if (age := time() - post.created_at.timestamp()) < settings.GRACE_PERIOD:
+                # None of the following posts are older, they are prepared until a later refresh sends them
+                self.poll.due(settings.GRACE_PERIOD - age)
+                waiting = [post_data for later, post_data in sorted(id_post_map.items()) if later > post_id]
+                self.warm_cache([post, *map(self.new_post, waiting)])
+                self._scanned = post_id - 1
+                return
+            self.check_warmed(post)
+            if not self.is_ok(post):
+                continue
+            yield post
+        self._scanned = latest_post_id
 
-        if self.last_post_id == latest_post_id:
+    def warm_cache(self, posts: Iterable[Post]):
+        """Download and convert posts in their grace period, so they are in the media cache once they are sent"""
+        if self.media_cache is None:
             return
+        for post in posts:
+            warming = self._warming.get(post.id)
+            if not post.md5 or (warming and warming[0] == post.md5) or not self.is_ok(post):
+                continue
+            self.check_warmed(post)
+            # Behind everything which is about to be sent
+            post.priority = float("inf")
+            self._warming[post.id] = post.md5, self.warmer.submit(self._warm, post)
 
-        posts = self.service.client.post_list(limit=latest_post_id - self.last_post_id)
-        id_post_map = dict(map(lambda post: (post["id"], post), posts))
+    def _warm(self, post: Post):
+        try:
+            post.prepare(self.qualities(post))
+            self.logger.debug(f"Prepared {post.id} during its grace period")
+        except Exception as error:
+            self.logger.warning(f"Preparing {post.id} during its grace period failed: {error}")
+        finally:
+            post.close()
 
-        for post_id in range(self.last_post_id + 1, latest_post_id + 1):
-            try:
-                post_dict = id_post_map.get(post_id, self.service.client.post_show(post_id))
-                if "id" not in post_dict:
-                    self.logger.warning("Skip restricted post")
-                    continue
-            except Exception as e:
-                self.logger.warning(f"Exception during downloading info for post {post_id}")
-                self.logger.exception(e)
+    def check_warmed(self, post: Post):
+        """Forget the media prepared for a post if its file was replaced in the meantime"""
+        if (warming := self._warming.pop(post.id, None)) is None or self.media_cache is None:
+            return
+        md5, future = warming
+        if md5 != post.md5:
+            self.logger.info(f"File of {post.id} changed during its grace period, dropping the prepared media")
+            # Only once the preparation is done, it may still be writing the old files
+            future.add_done_callback(lambda _: self.media_cache.discard(md5))  # type: ignore
+
+    def search_queries(self) -> tuple[list[str], set[str]]:
+        primary = [settings.SEARCH_TAGS] + settings.EXTRA_SEARCH_TAGS  # type: ignore
+        secondary = set()
+        if settings.SUBSCRIBER_SEARCH:
+            secondary = self.subscriptions.queries(self.service.tag_limit)
+        return primary, secondary
+
+    def _get_posts_by_search(self):
+        self.feed.set_queries(*self.search_queries(), default_cursor=self.last_post_id)
+
+        results = self.feed.fetch(use_cursor=not settings.LAST_100_TRACK)
+        if self.feed.failed:
+            self.poll.failed()
+        else:
+            self.poll.observe((post_id for result in results for post_id, _, _ in result), self.feed.complete)
+
+        for post_data, feeds in self.feed.merge(results):
+            if settings.LAST_100_TRACK and post_data.id in self.tracker:
                 continue
 
-            post = Post(post_dict, self.service)
-            if time() - post.created_at.timestamp() < settings.GRACE_PERIOD:
-                # None of the following posts are older thus we can toss it here
-                return
+            post = self.new_post(post_data)
+            # Subscribers get the same posts as the channel, banned and deleted ones and those the filter rejects are
+            # sent to nobody
             if not self.is_ok(post):
                 continue
+            post.to_channel = any(feed.primary for feed in feeds)
             yield post
-
-    def _get_posts_by_search(self):
-        posts = self.service.client.post_list(limit=100, tags=settings.SEARCH_TAGS)
-        # FIXME: The tracker doesn't seem to be transported over the threads very well by
-        # timeout_decorator thus we have to load it again
-        self.tracker.load()
-
-        for post_dict in reversed(posts):
-            if "id" not in post_dict:
-                self.logger.warning("Skip restricted post")
-                continue
-            if (not settings.LAST_100_TRACK and self.last_post_id >= post_dict["id"]) or (
-                settings.LAST_100_TRACK and post_dict["id"] in self.tracker
-            ):
+        self._scanned = self.feed.covered(results)
+
+    def _get_edited_posts(self):
+        """Posts which were edited since the last refresh and newly match the search and filter"""
+        post_ids, version_id = self.change_feed.fetch()
+        # Newer posts are handled by the normal feed. Older ones were either handled before the tracking started or
+        # dropped out of the tracker, either way they may have been sent already.
+        since = max(self.store.get("edit_track_start"), self.tracker.evicted)
+        post_ids = [
+            post_id for post_id in post_ids if since < post_id <= self.last_post_id and post_id not in self.tracker
+        ]
+
+        # Danbooru checks the search itself, it knows every metatag
+        matching = self.id_lookup.fetch(post_ids, tags=settings.SEARCH_TAGS)  # type: ignore
+        for post_id, post_data in sorted(matching.items()):
+            post = self.new_post(post_data)
+            if not self.is_ok(post):
                 continue
+            self.logger.info(f"Post {post_id} was edited and now matches")
+            yield post
 
-            post = Post(post_dict, self.service)
-            if not self.is_ok(post):
+        self.change_feed.commit(version_id)
+
+    def _get_outbox_posts(self):
+        """Posts with deliveries left over from a crash or restart and failed deliveries due for a retry"""
+        self.outbox.prune()
+        due = self.outbox.due()
+        if not due:
+            return
+
+        self.logger.info(f"Resuming {sum(map(len, due.values()))} deliveries of {len(due)} posts from the outbox")
+        found = self.id_lookup.fetch(due)
+        for post_id, entries in due.items():
+            if post_id not in found or found[post_id].is_banned or not found[post_id].file_url:
+                self.logger.warning(f"Post {post_id} is not available anymore, dropping its deliveries")
+                self.outbox.discard(post_id)
                 continue
+
+            post = self.new_post(found[post_id])
+            post.targets = [(entry.chat_id, entry.group) for entry in entries]
             yield post
 
     def get_posts(self):
-        if settings.SEARCH_TAGS:
+        if settings.EDIT_TRACK and self.store.get("edit_track_start") is None:
+            # Edits are only followed for posts handled from now on, the tracker doesn't know the older ones
+            self.store.set("edit_track_start", self.last_post_id)
+
+        yield from self._get_outbox_posts()
+
+        if settings.SEARCH_TAGS or settings.EXTRA_SEARCH_TAGS:
             yield from self._get_posts_by_search()
         else:
             yield from self._get_posts_by_number_only()
 
+        if settings.EDIT_TRACK:
+            yield from self._get_edited_posts()
+
     def telegram_cleaned_tags(self, tags: Iterable[str] | str) -> list[str]:
         if not isinstance(tags, str):
             tags = " ".join(tags)
@@ -215,9 +327,9 @@ class Command:
         return "#" + " #".join(tags)
 
     def get_sauce_url(self, post: Post) -> str:
-        if post.post.get("pixiv_id"):
+        if post.pixiv_id:
             return f"https://www.pixiv.net/member_illust.php?mode=medium&illust_id={post.pixiv_id}"
-        elif post.post.get("source") and not post.source.startswith("file://") :
+        elif post.source and not post.source.startswith("file://") :
             return post.source
         return ""
 
@@ -231,17 +343,9 @@ class Command:
 
         return tags | set(sample(sorted(available_tags - tags), k=fill_amount))
 
-    def match_tags(self, source: set, check: set, strict: bool = True) -> bool:
-        bad = set([tag[1:] for tag in check if tag.startswith("-")])
-        good = set([tag for tag in check if not tag.startswith("-")])
-
-        if source & bad:
-            return False
-        elif not strict and source & good:
-            return True
-        elif strict and source & good == good:
-            return True
-        return False
+    def extended_tags(self, post: Post) -> set[str]:
+        tags = set(post.tags) | set([post.rating_tag])
+        return SubscriptionIndex.intern_tags(tags | set(self.telegram_cleaned_tags(tags)))
 
     def named_source(self, post: Post) -> str | None:
         url = URL(self.get_sauce_url(post))
@@ -254,63 +358,156 @@ class Command:
             title += " - @" + url.path.split("/", 2)[1]
         elif title == "Fanbox":
             title += " - " + url.host.split(".")[-3].title()
-        elif post.post.get("tag_string_artist"):
-            artist = post.tag_string_artist
+        elif post.artist_tags:
+            artist = " ".join(post.artist_tags)
             title += " - " + artist.title()
 
         return title
 
-    def create_promise(self, post: Post) -> Promise:
-        targets = []
-        targets.append(self.create_post(post, settings.CHAT_ID))
-        for chat_id, config in self.config.items():
-            data = self.create_post(post, int(chat_id), config)
-            if data:
-                self.logger.debug(f'┃ Post also goes to: {chat_id} with tags {config["subs"]}')
-                targets.append(data)
-
-        return Promise(self.send_posts_to_targets, (targets, post.id), {})
+    def route(self, post: Post) -> list[tuple[int, str | None]]:
+        """Chat ids (and the matched subscription group) the post has to be sent to"""
+        targets: list[tuple[int, str | None]] = []
+        if post.to_channel:
+            targets.append((settings.CHAT_ID, None))
+        targets.extend(self.subscriptions.route(self.extended_tags(post)).items())
+        return targets
+
+    def advance(self, post_id: int):
+        """Move the cursors past ``post_id``, edited posts may be older than the last post"""
+        self.last_post_id = max(self.last_post_id, post_id)
+        self.feed.advance(post_id)
+        # Posts which were warmed but restricted or filtered out later never reach check_warmed
+        for warmed in [warmed for warmed in self._warming if warmed <= post_id]:
+            del self._warming[warmed]
+
+    def journal(self, post: Post) -> list[tuple[int, str | None]]:
+        """Write the deliveries of a new post to the outbox and mark the post as handled"""
+        if post.targets is not None:
+            return post.targets
+
+        targets = self.route(post)
+        self.outbox.add(post.id, targets)
+
+        self.advance(post.id)
+        if settings.LAST_100_TRACK or settings.EDIT_TRACK:
+            self.tracker.append(post.id)
+        return targets
+
+    def create_sends(self, post: Post, targets: list[tuple[int, str | None]]) -> list[tuple[Callable, dict]]:
+        config = self.config
+        sends = []
+        for chat_id, group in targets:
+            if chat_id == settings.CHAT_ID:
+                sends.append(self.create_post(post, settings.CHAT_ID))
+                continue
 
-    def send_posts_to_targets(self, targets: list[tuple[Callable, dict]], post_id: int):
+            chat_config = config.get(str(chat_id))
+            if not chat_config:
+                self.outbox.done(post.id, chat_id)
+                continue
+            self.logger.debug(f'┃ Post also goes to: {chat_id} with tags {chat_config["subs"].get(group)}')
+            sends.append(self.create_post(post, chat_id, chat_config, group=group))
+
+        for method, kwargs in sends:
+            self.outbox.set_method(post.id, kwargs["chat_id"], method.__name__)
+        return sends
+
+    def message_file_id(self, message: Message | None, kind: str) -> str | None:
+        attachment = getattr(message, kind, None)
+        if kind == "photo":
+            attachment = attachment[-1] if attachment else None
+        return attachment.file_id if attachment else None
+
+    def file_key(self, kwargs: dict) -> tuple[str, str] | None:
+        """Kind of the attached file and the key its file id is stored under, None for text messages"""
+        kind = next((kind for kind in self.FILE_KINDS if kind in kwargs), None)
+        if not kind:
+            return None
+        # Samples are different files than the original and get their own file ids
+        if (variant := getattr(kwargs[kind], "variant", None)) not in (None, "original"):
+            return kind, f"{kind}:{variant}"
+        return kind, kind
+
+    def upload(self, method: Callable, kwargs: dict) -> Message | None:
+        """Send with the files attached, their copies in the request body count towards the memory budget"""
+        nbytes = sum(value.nbytes for value in kwargs.values() if isinstance(value, MappedInputFile))
+        if not nbytes:
+            return method(**kwargs)
+
+        key = ("upload", kwargs["chat_id"], id(kwargs))
+        self.memory.add(key, nbytes)
         try:
-            for method, kwargs in targets:
-                self.logger.info(f'┃ {method.__name__.replace("_", " ").title()} to {kwargs["chat_id"]}')
-                try:
-                    method(**kwargs, queued=False)
-                except Exception as exc:
-                    self.logger.exception(exc)
+            return method(**kwargs)
         finally:
-            self.last_post_id = post_id
-            if settings.LAST_100_TRACK:
-                self.tracker.append(post_id)
-            if post_id in self._prepared_post_kwargs:
-                del self._prepared_post_kwargs[post_id]
+            self.memory.release(key)
+
+    def send_with_file_id(self, method: Callable, kwargs: dict, md5: str | None) -> Message | None:
+        """Send a post, reusing the Telegram file id if the same file was uploaded before"""
+        if not (file_key := self.file_key(kwargs)) or not md5:
+            return self.upload(method, kwargs)
+        kind, key = file_key
+
+        if file_id := self.store.file_id(md5, key):
+            reuse_kwargs = {name: value for name, value in kwargs.items() if name != "thumb"}
+            reuse_kwargs[kind] = file_id
+            try:
+                return method(**reuse_kwargs)
+            except BadRequest as error:
+                self.logger.warning(f"┃ Stored file id for {md5} is not valid anymore, uploading again: {error}")
+                self.store.forget_file_id(md5, key)
+
+        message = self.upload(method, kwargs)
+        if file_id := self.message_file_id(message, kind):
+            self.store.set_file_id(md5, key, file_id)
+        return message
+
+    def send_to_target(self, method: Callable, kwargs: dict, post_id: int, md5: str | None = None) -> bool:
+        self.logger.info(f'┃ {method.__name__.replace("_", " ").title()} to {kwargs["chat_id"]}')
+        try:
+            self.send_with_file_id(method, kwargs, md5)
+            self.outbox.done(post_id, kwargs["chat_id"])
+            return True
+        except Exception as exc:
+            self.logger.exception(exc)
+            self.outbox.failed(post_id, kwargs["chat_id"], exc)
+            return False
+
+    def send_posts_to_targets(self, targets: list[tuple[Callable, dict]], post_id: int, md5: str | None = None):
+        # Chats get different files (photo, sample or document), each is sent one by one until it was uploaded once.
+        # The other chats then get its file id in parallel, each limited by its own rate limit.
+        groups: dict[str | None, list[tuple[Callable, dict]]] = {}
+        for method, kwargs in targets:
+            file_key = self.file_key(kwargs)
+            groups.setdefault(file_key and file_key[1], []).append((method, kwargs))
+
+        remaining = groups.pop(None, [])
+        for group in groups.values():
+            while group:
+                method, kwargs = group.pop(0)
+                if self.send_to_target(method, kwargs, post_id, md5):
+                    break
+            remaining.extend(group)
+        list(self.fanout.map(lambda target: self.send_to_target(*target, post_id, md5), remaining))
 
     def create_post(
-        self, post: Post, chat_id: int, config: dict = {}, no_file: bool = False, force_file: bool = False
-    ) -> tuple[Callable, Dict] | None:
-        tags = set(post.tag_string.split(" "))
+        self,
+        post: Post,
+        chat_id: int,
+        config: dict = {},
+        no_file: bool = False,
+        force_file: bool = False,
+        group: str | None = None,
+    ) -> tuple[Callable, Dict]:
+        tags = set(post.tags)
         caption = ""
 
-        if config:
-            extended_tags = tags | set([post.rating_tag])
-            extended_tags = extended_tags | set(self.telegram_cleaned_tags(extended_tags))
-
-            for name, check_tags in config.get("subs", {}).items():
-                check_tags = set(check_tags)
-                if (name == "OR" and self.match_tags(extended_tags, check_tags, False)) or (
-                    name != "OR" and self.match_tags(extended_tags, check_tags)
-                ):
-                    if config.get("debug"):
-                        caption += f'<pre>matched with group "{name}"</pre>\n'
-                    break
-            else:
-                return
+        if group and config.get("debug"):
+            caption += f'<pre>matched with group "{group}"</pre>\n'
 
         if config.get("artist", settings.SHOW_ARTIST_TAG):
-            tags = tags - set([post.post.get("tag_string_artist", [])])
+            tags = tags - set(post.artist_tags)
         if config.get("characters", settings.SHOW_CHARACTER_TAG):
-            tags = tags - set(post.post.get("tag_string_character", []))
+            tags = tags - set(post.character_tags)
 
         tags = self.get_tags(tags)
         source = self.get_sauce_url(post)
@@ -324,10 +521,10 @@ class Command:
             caption += "\n<b>ID:</b> " + str(post.id)
         if config.get("tags", True) and tags:
             caption += "\n<b>Tags:</b> " + self.to_telegram_tags(tags)
-        if config.get("artist", settings.SHOW_ARTIST_TAG) and post.post.get("tag_string_artist"):
-            caption += "\n<b>Artist:</b> " + self.to_telegram_tags(post.tag_string_artist)
-        if config.get("characters", settings.SHOW_CHARACTER_TAG) and post.post.get("tag_string_character"):
-            caption += "\n<b>Characters:</b> " + self.to_telegram_tags(post.tag_string_character)
+        if config.get("artist", settings.SHOW_ARTIST_TAG) and post.artist_tags:
+            caption += "\n<b>Artist:</b> " + self.to_telegram_tags(post.artist_tags)
+        if config.get("characters", settings.SHOW_CHARACTER_TAG) and post.character_tags:
+            caption += "\n<b>Characters:</b> " + self.to_telegram_tags(post.character_tags)
         if config.get("suffix", settings.SUFFIX):
             suffix = config.get("suffix", settings.SUFFIX)
             if "{src}" in suffix or "{namedsrc}" in suffix:
@@ -337,14 +534,8 @@ class Command:
             else:
                 caption += suffix
 
-        if config.get("no_file", settings.NO_FILE):
-            no_file = True
-        if config.get("force_file", settings.FORCE_FILE):
-            force_file = True
-        if config.get("explicit_file", settings.EXPLICIT_FILE) and post.rating == "e":
-            force_file = True
-        if config.get("questionable_file", settings.QUESTIONABLE_FILE) and post.rating in "qe":
-            force_file = True
+        chat_no_file, chat_force_file = self.file_mode(post, config)
+        no_file, force_file = no_file or chat_no_file, force_file or chat_force_file
 
         buttons = None
         if config.get("buttons", settings.SHOW_BUTTONS):
@@ -371,7 +562,9 @@ class Command:
             "parse_mode": ParseMode.HTML,
         }
 
-        func, extra_kwargs = self.create_post_file_kwargs(post, force_file=force_file, no_file=no_file)
+        func, extra_kwargs = self.create_post_file_kwargs(
+            post, force_file=force_file, no_file=no_file, quality=self.chat_quality(config)
+        )
         kwargs.update(extra_kwargs)
 
         if no_file:
@@ -379,62 +572,87 @@ class Command:
             del kwargs["caption"]
         return func, kwargs
 
-    def create_post_file_kwargs(self, post, force_file=False, no_file=False):
-        if post.id in self._prepared_post_kwargs and not force_file and not no_file:
-            return self._prepared_post_kwargs[post.id]
+    def file_mode(self, post: Post, config: dict) -> tuple[bool, bool]:
+        """Whether a chat gets the post without file and whether it gets the original file as document"""
+        no_file = bool(config.get("no_file", settings.NO_FILE))
+        force_file = bool(
+            config.get("force_file", settings.FORCE_FILE)
+            or (config.get("explicit_file", settings.EXPLICIT_FILE) and post.rating == "e")
+            or (config.get("questionable_file", settings.QUESTIONABLE_FILE) and post.rating in "qe")
+        )
+        return no_file, force_file
+
+    def chat_quality(self, config: dict) -> int:
+        try:
+            return int(float(config.get("quality", settings.QUALITY) or 0))
+        except ValueError:
+            return settings.QUALITY  # type: ignore
+
+    def qualities(self, post: Post) -> set[int]:
+        """Photo qualities the chats a post goes to need, ``0`` stands for the original file"""
+        config = self.config
+        qualities = set()
+        for chat_id, _ in post.targets if post.targets is not None else self.route(post):
+            chat_config = {} if chat_id == settings.CHAT_ID else config.get(str(chat_id))
+            if chat_config is None:
+                continue
+            no_file, force_file = self.file_mode(post, chat_config)
+            if force_file:
+                qualities.add(0)
+            elif not no_file:
+                qualities.add(self.chat_quality(chat_config))
+        return qualities
+
+    def create_post_file_kwargs(self, post, force_file=False, no_file=False, quality=0):
+        # Everything but photos is the same for all qualities
+        quality = quality if post.is_image else 0
+        if not force_file and not no_file and quality in (prepared := self._prepared_post_kwargs.get(post.id, {})):
+            return prepared[quality]
 
-        post.file.seek(0)
-        file = InputFile(post.file, filename=f"{post.id}.{post.file_extension}")
         kwargs = {}
         if force_file:
             self.logger.info(f"┏ {post.id}: Preparing document as {post.file_extension}")
-            kwargs["document"] = file
+            kwargs["document"] = MappedInputFile(post.file, filename=f"{post.id}.{post.file_extension}")
             func = danbooru_bot.updater.bot.send_document
             return func, kwargs
         elif no_file:
             self.logger.info(f"┏ {post.id}: Forced no file")
             func = danbooru_bot.updater.bot.send_message
             return func, kwargs
-        elif post.is_image:
-            width, height = post.image_width, post.image_height
+
+        if post.is_image:
             self.logger.info(f"┏ {post.id}: Preparing photo")
-            if post.file_size > 10 * 1024**2 or width + height > 10000:
-                post.file.seek(0)
-                image = Image.new_from_buffer(post.file.read(), "")
-
-                while True:
-                    while width + height > 10000:
-                        width, height = int(width * 0.75), int(height * 0.75)
-
-                    if (scale := width / image.width) != 1:  # type: ignore
-                        image = image.resize(scale)  # type: ignore
-                        self.logger.info(f"┃ Resizing to a scale of {scale:.2f} [{image.width}x{image.height}]")
-
-                    with BytesIO() as out:
-                        out.write(image.write_to_buffer(".jpg"))  # type: ignore
-                        out.seek(0)
-                        new_length = len(out.read())
-                        if new_length > 10 * 1024**2:
-                            image = image.resize(0.9)  # type: ignore
-                            continue
-                        self.logger.info(
-                            f"┃ Reduced file size from {post.file_size / 1024**2:.2f}Mb to {new_length / 1024**2:.2f}Mb"
-                        )
-                        out.seek(0)
-                        file = InputFile(out, filename=f"{post.id}.jpg")
-                    break
+            photo, variant = post.photo_for(quality)
+            if variant != "original":
+                self.logger.info(f"┃ Using the {variant} sample for a quality of {quality}px")
+                filename = f"{post.id}{os.path.splitext(photo.name)[1]}"
+            elif post.needs_shrink:
+                new_length = os.fstat(photo.fileno()).st_size
+                self.logger.info(
+                    f"┃ Reduced file size from {(post.file_size or 0) / 1024**2:.2f}Mb to {new_length / 1024**2:.2f}Mb"
+                )
+                filename = f"{post.id}.jpg"
+            else:
+                filename = f"{post.id}.{post.file_extension}"
 
-            kwargs["photo"] = file
+            kwargs["photo"] = MappedInputFile(photo, filename=filename, variant=variant)
             func = danbooru_bot.updater.bot.send_photo
-        elif post.is_gif or (post.file_extension == "mp4" and not post.has_audio):
+            self._prepared_post_kwargs.setdefault(post.id, {})[quality] = (func, kwargs)
+            return func, kwargs
+
+        file = MappedInputFile(post.file, filename=f"{post.id}.{post.file_extension}")
+        thumb = None
+        if (post.is_gif or post.file_extension == "mp4") and post.thumbnail:
+            thumb = MappedInputFile(post.thumbnail, filename="thumb.jpg", attach=True)
+        if post.is_gif or (post.file_extension == "mp4" and not post.has_audio):
             self.logger.info(f"┏ {post.id}: Preparing gif")
             kwargs.update(
                 {
                     "animation": file,
-                    "duration": post.video.duration if post.video else None,
-                    "height": post.image_height,
-                    "width": post.image_width,
-                    "thumb": post.thumbnail,
+                    "duration": post.duration,
+                    "height": post.media_info.height or post.image_height,
+                    "width": post.media_info.width or post.image_width,
+                    "thumb": thumb,
                 }
             )
             func = danbooru_bot.updater.bot.send_animation
@@ -443,10 +661,11 @@ class Command:
             kwargs.update(
                 {
                     "video": file,
-                    "duration": post.video.duration,
-                    "height": post.image_height,
-                    "width": post.image_width,
+                    "duration": post.duration,
+                    "height": post.media_info.height or post.image_height,
+                    "width": post.media_info.width or post.image_width,
                     "supports_streaming ": True,
+                    "thumb": thumb,
                 }
             )
             func = danbooru_bot.updater.bot.send_video
@@ -455,7 +674,7 @@ class Command:
             kwargs["document"] = file
             func = danbooru_bot.updater.bot.send_document
 
-        self._prepared_post_kwargs[post.id] = [func, kwargs]
+        self._prepared_post_kwargs.setdefault(post.id, {})[quality] = (func, kwargs)
         return func, kwargs
 
     # @timeout(300, use_signals=False)
@@ -463,24 +682,70 @@ class Command:
         if self.is_refreshing:
             return
         self.is_refreshing = True
-        for post in posts:
+        # Download and convert the next posts in the background while the current one is sent, but only as long as
+        # they fit into the memory budget
+        with closing(
+            prefetch(
+                posts,
+                self.prepare_post,
+                depth=settings.PREFETCH,
+                admit=lambda post: self.memory.admit(post.id, post.file_size or 0),
+                release=self.release_post,
+            )
+        ) as prepared_posts:
+            completed = self._send_prepared_posts(prepared_posts)
+        # Posts which were skipped or filtered out after the last sent one don't move the cursors on their own, without
+        # this a page full of them would be fetched again on every refresh
+        if completed and self._scanned is not None:
+            self.advance(self._scanned)
+        # Whatever is still held belongs to posts which were prefetched but never sent
+        self.memory.evict(max_age=0)
+        self.is_refreshing = False
+
+    def prepare_post(self, post: Post):
+        post.prepare(self.qualities(post))
+        self.memory.update(post.id, post.nbytes)
+
+    def release_post(self, post: Post):
+        self._drop_prepared(post.id)
+        post.close()
+        self.memory.release(post.id)
+
+    def _drop_prepared(self, post_id: int):
+        self._prepared_post_kwargs.pop(post_id, None)
+
+    def _send_prepared_posts(self, prepared_posts: Iterable[tuple[Post, Future]]) -> bool:
+        """Send the posts in order, False if the refresh was stopped before all of them were handled"""
+        for post, prepared in prepared_posts:
+            stopped = False
             if not self.is_refreshing:
                 self.logger.info("Early termination")
-                return
-
-            if ((self.job and self.job.removed) or (not self.job)) and not self.is_manual_refresh:
+                stopped = True
+            elif ((self.job and self.job.removed) or (not self.job)) and not self.is_manual_refresh:
                 self.logger.info("Scheduled task was stopped while refreshing")
-                break
+                stopped = True
+            if stopped:
+                # The posts behind this one are released by prefetch once it is closed
+                prepared.add_done_callback(lambda _, post=post: self.release_post(post))
+                return False
 
             try:
-                post.prepare()
-                promise = self.create_promise(post)
-                danbooru_bot.updater.bot._msg_queue(promise, True)  # type: ignore
-                promise.result()
+                targets = self.journal(post)
+            except Exception as e:
+                self.logger.exception(e)
+                continue
+
+            try:
+                prepared.result()
+                sends = self.create_sends(post, targets)
+                self.send_posts_to_targets(sends, post.id, post.md5)
                 self.logger.info("┗━━")
             except Exception as e:
                 self.logger.exception(e)
-        self.is_refreshing = False
+                self.outbox.failed(post.id, error=e)
+            finally:
+                self.release_post(post)
+        return True
 
     def refresh(self, *args, is_manual: bool = False):
         if self.is_refreshing:
@@ -491,12 +756,19 @@ class Command:
             self.is_manual_refresh = True
 
         self.logger.info("Start refresh")
+        self._scanned = None
+        cursor = self.store.get("last_post_id")
         try:
             self.send_posts(self.get_posts())
         except TimeoutError:
             self.logger.info("Refresh took too long and was aborted")
+        except Exception:
+            self.poll.failed()
+            raise
         finally:
             self.is_refreshing = False
+            # A backlog is only continued right away while it is worked off, not when the same page is stuck
+            self.schedule_next_refresh(progressed=self.store.get("last_post_id") != cursor)
         self.logger.info("Finished refresh")
 
     def start_scheduler(self):
@@ -504,10 +776,18 @@ class Command:
             return
 
         self.logger.info("Starting scheduled job")
+        # Every refresh moves the next one according to the upload rate, see schedule_next_refresh
         self.job = danbooru_bot.updater.job_queue.run_repeating(
             self.refresh, interval=timedelta(minutes=settings.RELOAD_INTEVAL), first=1, name="danbooru_refresh"
         )
 
+    def schedule_next_refresh(self, progressed: bool = True):
+        if not self.job or self.job.removed:
+            return
+        interval = self.poll.next(progressed=progressed)
+        self.logger.info(f"Next refresh in {interval:.0f}s")
+        self.job.job.modify(next_run_time=datetime.now(timezone.utc) + timedelta(seconds=interval))
+
     def stop_refresh(self, is_manual: bool = False, remove: bool = True):
         self.is_refreshing = False
 
@@ -524,28 +804,24 @@ class Command:
 
     @property
     def config(self) -> dict:
-        return json.loads(self._sub_config.read_text() or "{}")
-
-    @config.setter
-    def config(self, value: dict):
-        self._sub_config.write_text(json.dumps(value, indent=4, sort_keys=True))
+        return self.store.chats()
 
     def change_config(self, chat_id: int or str, update: dict):
         if int(chat_id) == settings.CHAT_ID:
             return {}
         self._config_set_default(chat_id)
-        config = self.config
-        key = str(chat_id)
-        config[key].update(update)
-        self.config = config
-        return config[key]
+        config = self.store.chat(chat_id)
+        config.update(update)  # type: ignore
+        self.store.set_chat(chat_id, config)  # type: ignore
+        if "subs" in update:
+            self.subscriptions.update_chat(chat_id, config)
+        return config
 
     def _config_set_default(self, chat_id: int or str):
         if int(chat_id) == settings.CHAT_ID:
             return
-        config = self.config
-        if not config.get(str(chat_id)):
-            config[str(chat_id)] = {
+        if not self.store.chat(chat_id):
+            config = {
                 "time": False,
                 "artist": False,
                 "id": False,
@@ -558,7 +834,8 @@ class Command:
                 "force_file": False,
                 "no_file": False,
             }
-            self.config = config
+            self.store.set_chat(chat_id, config)
+            self.subscriptions.update_chat(chat_id, config)
 
     def config_set_value(self, chat_id: int or str, key: str, value: Any):
         if int(chat_id) == settings.CHAT_ID:
@@ -569,7 +846,7 @@ class Command:
         if int(chat_id) == settings.CHAT_ID:
             return {}
         self._config_set_default(chat_id)
-        result = self.config[str(chat_id)]
+        result = self.store.chat(chat_id)
         return result.get(key, default) if key else result
 
     # # # # # # # # #
@@ -722,6 +999,12 @@ class Command:
             update.message.reply_text("Job scheduled for removal")
         self.stop_refresh(is_manual=manual)
 
+    def memory_command(self, update: Update, context: CallbackContext):
+        update.message.reply_text(
+            f"{self.memory.summary()}\nPrepared: {len(self._prepared_post_kwargs)}\nOutbox: {len(self.outbox)}\n"
+            f"Waiting conversions: {self.transcoder.queued}\n{self.service.session.summary()}\n{self.poll.summary()}"
+        )
+
     def cancel_command(self, update: Update, context: CallbackContext):
         if not self.is_refreshing:
             return update.message.reply_text("No running refresh")
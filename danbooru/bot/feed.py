@@ -0,0 +1,297 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from itertools import groupby
+import logging
+from operator import attrgetter, itemgetter
+from time import time
+from typing import Iterable, Iterator
+
+from pybooru import Danbooru as PyDanbooru
+
+from danbooru.bot.animedatabase_utils.post_data import ONLY, PostData
+from danbooru.bot.store import Store
+
+# Maximum amount of posts Danbooru returns per page
+PAGE_LIMIT = 200
+
+
+def fetch_after(
+    client: PyDanbooru, tags: str, after: int, max_pages: int = 0, limit: int = PAGE_LIMIT
+) -> tuple[list[PostData], bool]:
+    """Fetch all posts newer than ``after`` using Danbooru's ``page=a<id>`` cursors
+
+    Args:
+        client (:obj:`PyDanbooru`): Danbooru client
+        tags (:obj:`str`): Search tags, may be empty
+        after (:obj:`int`): Only posts with a higher id are fetched
+        max_pages (:obj:`int`): Stop after this many requests, 0 for no limit
+        limit (:obj:`int`): Posts per page
+
+    Returns:
+        :obj:`tuple`: Posts ordered by id and if all posts newer than ``after`` were fetched
+    """
+    posts = []
+    pages = 0
+    while not max_pages or pages < max_pages:
+        page = client.post_list(limit=limit, page=f"a{after}", tags=tags, only=ONLY)
+        pages += 1
+
+        ids = [post["id"] for post in page if "id" in post]
+        posts.extend(PostData.from_json(post) for post in page if "id" in post)
+        if len(page) < limit or not ids:
+            return sorted(posts, key=attrgetter("id")), True
+        after = max(ids)
+    return sorted(posts, key=attrgetter("id")), False
+
+
+class NegativeCache:
+    """Bounded set of ids which expire after ``ttl`` seconds"""
+
+    def __init__(self, ttl: float = 3600, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[int, float] = OrderedDict()
+
+    def __contains__(self, item: int) -> bool:
+        expires = self._entries.get(item)
+        if expires is None:
+            return False
+        elif expires < time():
+            del self._entries[item]
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, item: int):
+        self._entries[item] = time() + self.ttl
+        self._entries.move_to_end(item)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class IdLookup:
+    """Look up posts by id in batches of ``id:1,2,3`` searches
+
+    Ids Danbooru does not return (restricted or deleted posts) are remembered so that they are not requested again on
+    the next refresh. With ``tags`` only the posts matching them are returned, the others are not remembered as they
+    may match later.
+    """
+
+    def __init__(self, client: PyDanbooru, batch_size: int = 100, ttl: float = 3600):
+        self.client = client
+        self.batch_size = batch_size
+        self.missing = NegativeCache(ttl=ttl)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def fetch(self, ids: Iterable[int], tags: str = "") -> dict[int, PostData]:
+        ids = [post_id for post_id in ids if post_id not in self.missing]
+        found = {}
+        for index in range(0, len(ids), self.batch_size):
+            batch = ids[index : index + self.batch_size]
+            try:
+                query = f'id:{",".join(map(str, batch))} {tags}'.strip()
+                posts = self.client.post_list(limit=len(batch), tags=query, only=ONLY)
+            except Exception as e:
+                self.logger.warning(f"Exception during downloading info for posts {batch[0]} - {batch[-1]}")
+                self.logger.exception(e)
+                continue
+
+            found.update((post["id"], PostData.from_json(post)) for post in posts if "id" in post)
+            if tags:
+                continue
+            for post_id in batch:
+                if post_id not in found:
+                    self.missing.add(post_id)
+        return found
+
+
+class QueryFeed:
+    """A single Danbooru search with its own cursor (the highest post id already handled)"""
+
+    def __init__(self, tags: str, cursor: int, primary: bool = True):
+        self.tags = tags
+        self.cursor = cursor
+        self.primary = primary
+        self.complete = True
+        self.failed = False
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.tags!r} cursor={self.cursor} primary={self.primary}>"
+
+    def fetch(self, client: PyDanbooru, use_cursor: bool = True, max_pages: int = 0) -> list[PostData]:
+        """Fetch the posts of this query, oldest first
+
+        With ``use_cursor`` every post newer than the cursor is fetched page by page (see :func:`fetch_after`),
+        otherwise only the latest 100 posts are returned.
+        """
+        if not use_cursor:
+            self.complete = True
+            posts = client.post_list(limit=100, tags=self.tags, only=ONLY)
+            return sorted((PostData.from_json(post) for post in posts if "id" in post), key=attrgetter("id"))
+
+        posts, self.complete = fetch_after(client, self.tags, self.cursor, max_pages=max_pages)
+        return posts
+
+
+class UnionFeed:
+    """Runs multiple queries concurrently and merges their results into one stream ordered by post id
+
+    Primary queries (``SEARCH_TAGS`` and ``EXTRA_SEARCH_TAGS``) feed the main channel, secondary queries are derived
+    from subscriber groups and only feed the subscribers.
+    """
+
+    def __init__(self, client: PyDanbooru, store: Store, concurrency: int = 4, max_pages: int = 0):
+        self.client = client
+        self.store = store
+        self.concurrency = concurrency
+        self.max_pages = max_pages
+        self.feeds: dict[str, QueryFeed] = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def save(self):
+        self.store.set_many({f"query_cursor:{tags}": feed.cursor for tags, feed in self.feeds.items()})
+
+    def set_queries(self, primary: Iterable[str], secondary: Iterable[str], default_cursor: int):
+        primary = list(dict.fromkeys(filter(None, primary)))
+        secondary = [tags for tags in dict.fromkeys(filter(None, secondary)) if tags not in primary]
+
+        feeds = {}
+        for tags, is_primary in [(tags, True) for tags in primary] + [(tags, False) for tags in secondary]:
+            feed = self.feeds.get(tags) or QueryFeed(tags, self.store.get(f"query_cursor:{tags}", default_cursor))
+            feed.primary = is_primary
+            feeds[tags] = feed
+        self.feeds = feeds
+
+    def _fetch(self, feed: QueryFeed, use_cursor: bool) -> list[tuple[int, PostData, QueryFeed]]:
+        try:
+            posts = feed.fetch(self.client, use_cursor, max_pages=self.max_pages)
+            feed.failed = False
+        except Exception as e:
+            self.logger.warning(f'Exception during fetching "{feed.tags}"')
+            self.logger.exception(e)
+            feed.failed = True
+            return []
+
+        if not feed.complete:
+            self.logger.info(f'More posts for "{feed.tags}" available than fetched, continuing next refresh')
+        return [(post.id, post, feed) for post in posts]
+
+    @property
+    def complete(self) -> bool:
+        """Whether the last fetch got every new post of every feed"""
+        return all(feed.complete for feed in self.feeds.values())
+
+    @property
+    def failed(self) -> bool:
+        """Whether every feed failed in the last fetch"""
+        return bool(self.feeds) and all(feed.failed for feed in self.feeds.values())
+
+    def fetch(self, use_cursor: bool = True) -> list[list[tuple[int, PostData, QueryFeed]]]:
+        """Run all queries concurrently, the results are combined by :meth:`merge`"""
+        if not self.feeds:
+            return []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="feed") as executor:
+            return list(executor.map(lambda feed: self._fetch(feed, use_cursor), self.feeds.values()))
+
+    def posts(self, use_cursor: bool = True) -> Iterator[tuple[PostData, set[QueryFeed]]]:
+        return self.merge(self.fetch(use_cursor))
+
+    @staticmethod
+    def _horizon(results: list[list[tuple[int, PostData, QueryFeed]]]) -> int | None:
+        # The last post fetched by the feeds which hit max_pages, nothing newer may be merged yet
+        return min((result[-1][0] for result in results if result and not result[-1][2].complete), default=None)
+
+    def covered(self, results: list[list[tuple[int, PostData, QueryFeed]]]) -> int | None:
+        """Highest post id up to which :meth:`merge` looked at every fetched post"""
+        horizon = self._horizon(results)
+        if horizon is not None:
+            return horizon
+        return max((result[-1][0] for result in results if result), default=None)
+
+    def merge(self, results: list[list[tuple[int, PostData, QueryFeed]]]) -> Iterator[tuple[PostData, set[QueryFeed]]]:
+        """Yield each post once together with all feeds that returned it, ordered by id
+
+        When a feed hit ``max_pages`` the stream stops at the last post it fetched, so that no other feed can move the
+        cursors past posts which were not fetched yet.
+        """
+        horizon = self._horizon(results)
+
+        merged = heapq.merge(*results, key=itemgetter(0))
+        for post_id, group in groupby(merged, key=itemgetter(0)):
+            if horizon is not None and post_id > horizon:
+                return
+            entries = list(group)
+            yield entries[0][1], {feed for _, _, feed in entries}
+
+    def advance(self, post_id: int):
+        """Mark everything up to ``post_id`` as handled, valid as posts are processed in ascending order
+
+        Feeds whose last fetch failed keep their cursor, so they catch up on the next refresh.
+        """
+        if not self.feeds:
+            return
+        for feed in self.feeds.values():
+            if not feed.failed:
+                feed.cursor = max(feed.cursor, post_id)
+        self.save()
+
+
+class ChangeFeed:
+    """Follows Danbooru's post version history to find posts whose tags or rating changed
+
+    The id of the newest version seen is persisted in the store. On the first start the history is not replayed, only
+    edits made from then on are reported.
+    """
+
+    def __init__(self, client: PyDanbooru, store: Store, max_pages: int = 0, limit: int = PAGE_LIMIT):
+        self.client = client
+        self.store = store
+        self.max_pages = max_pages
+        self.limit = limit
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def cursor(self) -> int:
+        cursor = self.store.get("post_versions_cursor")
+        if cursor is None:
+            latest = next(iter(self._versions(limit=1)), None)
+            cursor = self.cursor = latest["id"] if latest else 0
+        return cursor
+
+    @cursor.setter
+    def cursor(self, value: int):
+        self.store.set("post_versions_cursor", value)
+
+    def _versions(self, **params) -> list[dict]:
+        return self.client._get("post_versions.json", params)
+
+    def fetch(self) -> tuple[list[int], int]:
+        """Fetch the ids of all posts edited since the cursor
+
+        Returns:
+            :obj:`tuple`: Ids of edited posts in ascending order and the version id to pass to :meth:`commit` once
+            they were handled
+        """
+        after = self.cursor
+        post_ids = set()
+        pages = 0
+        while not self.max_pages or pages < self.max_pages:
+            versions = self._versions(limit=self.limit, page=f"a{after}")
+            pages += 1
+            for version in versions:
+                if version.get("version", 1) > 1 and (
+                    version.get("added_tags") or version.get("removed_tags") or version.get("rating_changed")
+                ):
+                    post_ids.add(version["post_id"])
+            if versions:
+                after = max(after, *(version["id"] for version in versions))
+            if len(versions) < self.limit:
+                break
+        return sorted(post_ids), after
+
+    def commit(self, version_id: int):
+        if version_id > self.cursor:
+            self.cursor = version_id
@@ -0,0 +1,124 @@
+from dataclasses import dataclass, field
+import logging
+import os
+from threading import Lock
+from time import monotonic
+from typing import Callable, Hashable
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}{unit}"
+        size /= 1024
+    return f"{size:.1f}GiB"
+
+
+def process_rss() -> int | None:
+    """Resident set size of this process, ``None`` where ``/proc`` isn't available"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@dataclass
+class Reservation:
+    nbytes: int
+    since: float = field(default_factory=monotonic)
+    touched: float = field(default_factory=monotonic)
+
+
+class MemoryBudget:
+    """Accounting of the bytes held by prepared posts and uploads in progress
+
+    Every post reserves its expected size before it is prepared and reports its actual size afterwards. New posts are
+    only admitted while the reservations fit into ``budget``, which slows down fetching and preparing when sending falls
+    behind. Reservations not touched for ``ttl`` seconds are considered leaked and evicted, ``on_evict`` is called with
+    their key to drop whatever is still held for them.
+    """
+
+    def __init__(self, budget: int, ttl: float = 3600, on_evict: Callable[[Hashable], None] | None = None):
+        self.budget = budget
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.peak = 0
+        self._reservations: dict[Hashable, Reservation] = {}
+        self._lock = Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __len__(self) -> int:
+        return len(self._reservations)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._reservations
+
+    @property
+    def used(self) -> int:
+        return sum(reservation.nbytes for reservation in list(self._reservations.values()))
+
+    @property
+    def available(self) -> int:
+        return self.budget - self.used
+
+    def admit(self, key: Hashable, nbytes: int) -> bool:
+        """Reserve ``nbytes`` for ``key`` if they fit into the budget, nothing is reserved otherwise"""
+        self.evict()
+        with self._lock:
+            if key not in self._reservations and self.used + nbytes > self.budget:
+                return False
+            self._set(key, nbytes)
+            return True
+
+    def update(self, key: Hashable, nbytes: int):
+        """Set the actual size held for ``key``, reserving it if it wasn't yet"""
+        with self._lock:
+            self._set(key, nbytes)
+
+    def add(self, key: Hashable, nbytes: int):
+        with self._lock:
+            self._set(key, nbytes + (reservation.nbytes if (reservation := self._reservations.get(key)) else 0))
+
+    def _set(self, key: Hashable, nbytes: int):
+        if reservation := self._reservations.get(key):
+            reservation.nbytes = nbytes
+            reservation.touched = monotonic()
+        else:
+            self._reservations[key] = Reservation(nbytes)
+        self.peak = max(self.peak, self.used)
+
+    def release(self, key: Hashable):
+        with self._lock:
+            self._reservations.pop(key, None)
+
+    def evict(self, max_age: float | None = None) -> list[Hashable]:
+        """Drop reservations which weren't touched for ``max_age`` (default ``ttl``) seconds"""
+        deadline = monotonic() - (self.ttl if max_age is None else max_age)
+        with self._lock:
+            stale = [key for key, reservation in self._reservations.items() if reservation.touched <= deadline]
+            for key in stale:
+                del self._reservations[key]
+
+        for key in stale:
+            self.logger.info(f"Evicted reservation of {key}")
+            if self.on_evict:
+                self.on_evict(key)
+        return stale
+
+    def summary(self, top: int = 5) -> str:
+        with self._lock:
+            reservations = sorted(self._reservations.items(), key=lambda item: item[1].nbytes, reverse=True)
+            used = sum(reservation.nbytes for _, reservation in reservations)
+
+        lines = [
+            f"Used: {format_bytes(used)} of {format_bytes(self.budget)} ({used / self.budget:.0%})",
+            f"Peak: {format_bytes(self.peak)}",
+            f"Posts: {len(reservations)}",
+        ]
+        if (rss := process_rss()) is not None:
+            lines.append(f"Process RSS: {format_bytes(rss)}")
+        now = monotonic()
+        for key, reservation in reservations[:top]:
+            lines.append(f"  {key}: {format_bytes(reservation.nbytes)}, held for {now - reservation.since:.0f}s")
+        return "\n".join(lines)
@@ -0,0 +1,113 @@
+from collections import defaultdict
+from dataclasses import dataclass
+import logging
+from time import time
+from typing import Iterable
+
+from danbooru.bot.store import Store
+
+PENDING = "pending"
+RETRY = "retry"
+FAILED = "failed"
+
+
+@dataclass
+class OutboxEntry:
+    post_id: int
+    chat_id: int
+    group: str | None = None
+    method: str | None = None
+    attempts: int = 0
+
+
+class Outbox:
+    """Durable journal of every (post, chat) delivery
+
+    Targets are journaled before anything is sent and removed once the message went through. Entries left over after a
+    crash or restart are still ``pending`` and delivered on the next refresh. Failed deliveries go to the retry lane
+    with exponential backoff and are given up after ``max_attempts``.
+    """
+
+    def __init__(self, store: Store, max_attempts: int = 5, backoff: float = 60, max_backoff: float = 3600):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __len__(self) -> int:
+        with self.store.transaction() as connection:
+            return connection.execute("SELECT COUNT(*) FROM outbox WHERE status != ?", (FAILED,)).fetchone()[0]
+
+    def add(self, post_id: int, targets: Iterable[tuple[int, str | None]]):
+        now = time()
+        with self.store.transaction() as connection:
+            connection.executemany(
+                """
+                INSERT INTO outbox (post_id, chat_id, group_name, status, attempts, next_attempt, created)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT (post_id, chat_id) DO NOTHING
+                """,
+                [(post_id, chat_id, group, PENDING, now, now) for chat_id, group in targets],
+            )
+
+    def set_method(self, post_id: int, chat_id: int, method: str):
+        with self.store.transaction() as connection:
+            connection.execute(
+                "UPDATE outbox SET method = ? WHERE post_id = ? AND chat_id = ?", (method, post_id, chat_id)
+            )
+
+    def done(self, post_id: int, chat_id: int):
+        with self.store.transaction() as connection:
+            connection.execute("DELETE FROM outbox WHERE post_id = ? AND chat_id = ?", (post_id, chat_id))
+
+    def discard(self, post_id: int):
+        with self.store.transaction() as connection:
+            connection.execute("DELETE FROM outbox WHERE post_id = ?", (post_id,))
+
+    def failed(self, post_id: int, chat_id: int | None = None, error: Exception | str = ""):
+        """Move a target (or all open targets of a post) to the retry lane"""
+        query = "SELECT chat_id, attempts FROM outbox WHERE post_id = ? AND status != ?"
+        params: tuple = (post_id, FAILED)
+        if chat_id is not None:
+            query += " AND chat_id = ?"
+            params += (chat_id,)
+
+        with self.store.transaction() as connection:
+            for target_chat_id, attempts in connection.execute(query, params).fetchall():
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    status, next_attempt = FAILED, None
+                    self.logger.warning(f"Giving up on post {post_id} to {target_chat_id} after {attempts} attempts")
+                else:
+                    status = RETRY
+                    next_attempt = time() + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+                connection.execute(
+                    """
+                    UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, error = ?
+                    WHERE post_id = ? AND chat_id = ?
+                    """,
+                    (status, attempts, next_attempt, str(error), post_id, target_chat_id),
+                )
+
+    def due(self, now: float | None = None) -> dict[int, list[OutboxEntry]]:
+        """Open entries which should be (re)sent now, grouped by post id in ascending order"""
+        with self.store.transaction() as connection:
+            rows = connection.execute(
+                """
+                SELECT post_id, chat_id, group_name, method, attempts FROM outbox
+                WHERE status IN (?, ?) AND next_attempt <= ?
+                ORDER BY post_id, rowid
+                """,
+                (PENDING, RETRY, now or time()),
+            ).fetchall()
+
+        entries = defaultdict(list)
+        for row in rows:
+            entries[row[0]].append(OutboxEntry(*row))
+        return dict(entries)
+
+    def prune(self, age: float = 7 * 24 * 3600):
+        """Remove entries which were given up on more than ``age`` seconds ago"""
+        with self.store.transaction() as connection:
+            connection.execute("DELETE FROM outbox WHERE status = ? AND created < ?", (FAILED, time() - age))
@@ -0,0 +1,53 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+def prefetch(
+    items: Iterable[T],
+    prepare: Callable[[T], Any],
+    depth: int = 3,
+    admit: Callable[[T], bool] | None = None,
+    release: Callable[[T], Any] | None = None,
+) -> Iterator[tuple[T, Future]]:
+    """Run ``prepare`` on the next ``depth`` items in background threads while the current one is consumed
+
+    Items are yielded in their original order together with the future of their preparation. Calling ``result()`` on
+    it waits for the preparation to finish and re-raises its exception. Unstarted preparations are cancelled when the
+    generator is closed early.
+
+    ``admit`` applies backpressure: as long as it returns ``False`` for the next item, already running items are handed
+    out first instead of reading and preparing more. The oldest item is always handed out, so this can't deadlock.
+
+    ``release`` is called for every item which was prepared (or started to) but not handed out when the generator is
+    closed early or its input raises, once its preparation has finished.
+    """
+    if depth <= 0:
+        for item in items:
+            future: Future = Future()
+            try:
+                future.set_result(prepare(item))
+            except Exception as error:
+                future.set_exception(error)
+            yield item, future
+        return
+
+    iterator = iter(items)
+    pending: deque[tuple[T, Future]] = deque()
+    executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch")
+    try:
+        for item in iterator:
+            while pending and admit and not admit(item):
+                yield pending.popleft()
+            pending.append((item, executor.submit(prepare, item)))
+            if len(pending) > depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if release:
+            for item, future in pending:
+                future.add_done_callback(lambda _, item=item: release(item))
@@ -0,0 +1,318 @@
+"""Local evaluation of Danbooru like search queries
+
+Danbooru limits the amount of tags per search depending on the account level. Queries compiled here are evaluated
+against the already fetched post JSON, so that the server side search can stay broad while complex filtering happens
+locally.
+
+Supported syntax:
+
+- ``tag1 tag2``: both tags must be present (AND)
+- ``tag1 or tag2``: either of the two (OR), ``~tag1 ~tag2`` works too
+- ``-tag``: tag must not be present (NOT)
+- ``( ... )``: group expressions, e.g. ``-( tag1 or tag2 )``
+- ``*``: wildcard inside tags, e.g. ``*_(cosplay)``
+- Metatags: ``score``, ``favcount``, ``id``, ``width``, ``height``, ``tagcount``, ``mpixels`` (number ranges like
+  ``>10``, ``<=5``, ``10..20``, ``1,2,3``), ``rating:g,s``, ``filetype:png,jpg`` and
+  ``status:deleted|banned|pending|flagged|active|any``
+
+Other Danbooru metatags (``user``, ``age``, ``is``, ...) need data the post JSON doesn't have and raise a
+:class:`QueryError` instead of silently never matching.
+"""
+
+from fnmatch import fnmatchcase
+from functools import lru_cache
+import operator
+import re
+from typing import Any, Callable, Iterable
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Context:
+    __slots__ = ("post", "tags")
+
+    def __init__(self, post: Any):
+        self.post = post
+        # PostData comes with its tags already split
+        tags = getattr(post, "tags", None)
+        self.tags = tags if tags is not None else frozenset(post.get("tag_string", "").split())
+
+
+Predicate = Callable[[Context], bool]
+
+NUMERIC_METATAGS: dict[str, Callable[[dict], float | None]] = {
+    "score": lambda post: post.get("score"),
+    "favcount": lambda post: post.get("fav_count"),
+    "id": lambda post: post.get("id"),
+    "width": lambda post: post.get("image_width"),
+    "height": lambda post: post.get("image_height"),
+    "tagcount": lambda post: post.get("tag_count"),
+    "mpixels": lambda post: (post.get("image_width") or 0) * (post.get("image_height") or 0) / 1_000_000,
+}
+
+STATUS_FLAGS = {
+    "deleted": "is_deleted",
+    "banned": "is_banned",
+    "pending": "is_pending",
+    "flagged": "is_flagged",
+}
+
+# Metatags which only influence the order or amount of search results
+IGNORED_METATAGS = {"order", "limit", "random"}
+
+# Danbooru metatags which can't be evaluated on the fetched posts
+UNSUPPORTED_METATAGS = {
+    "age",
+    "approver",
+    "appealer",
+    "arttags",
+    "chartags",
+    "child",
+    "comm",
+    "commenter",
+    "commentary",
+    "copytags",
+    "date",
+    "disapproved",
+    "downvote",
+    "duration",
+    "embedded",
+    "exif",
+    "fav",
+    "favgroup",
+    "filesize",
+    "flagger",
+    "gentags",
+    "has",
+    "is",
+    "locked",
+    "md5",
+    "metatags",
+    "noter",
+    "noteupdater",
+    "ordfav",
+    "ordfavgroup",
+    "ordpool",
+    "parent",
+    "pixiv",
+    "pixiv_id",
+    "pool",
+    "ratio",
+    "search",
+    "source",
+    "upvote",
+    "user",
+}
+
+COMPARATORS = [
+    (">=", operator.ge),
+    ("<=", operator.le),
+    (">", operator.gt),
+    ("<", operator.lt),
+]
+
+
+def _number(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError(f'"{value}" is not a number')
+
+
+def _range(value: str) -> Callable[[float], bool]:
+    for prefix, compare in COMPARATORS:
+        if value.startswith(prefix):
+            limit = _number(value[len(prefix) :])
+            return lambda number: compare(number, limit)
+
+    if ".." in value:
+        start, end = value.split("..", 1)
+        low = _number(start) if start else float("-inf")
+        high = _number(end) if end else float("inf")
+        return lambda number: low <= number <= high
+
+    options = frozenset(map(_number, value.split(",")))
+    return lambda number: number in options
+
+
+def _numeric(name: str, value: str) -> Predicate:
+    getter = NUMERIC_METATAGS[name]
+    check = _range(value)
+
+    def predicate(context: Context) -> bool:
+        number = getter(context.post)
+        return number is not None and check(number)
+
+    return predicate
+
+
+def _rating(value: str) -> Predicate:
+    ratings = frozenset(item[:1].lower() for item in value.split(",") if item)
+    return lambda context: context.post.get("rating") in ratings
+
+
+def _filetype(value: str) -> Predicate:
+    extensions = frozenset(item.lower().lstrip(".") for item in value.split(",") if item)
+    return lambda context: context.post.get("file_ext") in extensions
+
+
+def _status(value: str) -> Predicate:
+    value = value.lower()
+    if value == "any":
+        return lambda context: True
+    elif value == "active":
+        return lambda context: not any(context.post.get(flag) for flag in STATUS_FLAGS.values())
+    elif value in STATUS_FLAGS:
+        flag = STATUS_FLAGS[value]
+        return lambda context: bool(context.post.get(flag))
+    raise QueryError(f'Unknown status "{value}"')
+
+
+def _tag(tag: str) -> Predicate:
+    if "*" in tag:
+        return lambda context: any(fnmatchcase(item, tag) for item in context.tags)
+    return lambda context: tag in context.tags
+
+
+def _term(term: str) -> Predicate:
+    name, _, value = term.partition(":")
+    name = name.lower()
+    if value:
+        if name in NUMERIC_METATAGS:
+            return _numeric(name, value)
+        elif name == "rating":
+            return _rating(value)
+        elif name == "filetype":
+            return _filetype(value)
+        elif name == "status":
+            return _status(value)
+        elif name in IGNORED_METATAGS:
+            return lambda context: True
+        elif name in UNSUPPORTED_METATAGS:
+            raise QueryError(f'Metatag "{name}" is not supported by the local filter')
+    return _tag(term.lower())
+
+
+def _all(predicates: list[Predicate]) -> Predicate:
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda context: all(predicate(context) for predicate in predicates)
+
+
+def _any(predicates: list[Predicate]) -> Predicate:
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda context: any(predicate(context) for predicate in predicates)
+
+
+def _not(predicate: Predicate) -> Predicate:
+    return lambda context: not predicate(context)
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for word in text.split():
+        prefix = []
+        while word and word[0] in "-~" and len(word) > 1:
+            prefix.append(word[0])
+            word = word[1:]
+        while word.startswith("("):
+            tokens.extend(prefix + ["("])
+            prefix = []
+            word = word[1:]
+
+        # Tags may contain parentheses like "saber_(fate)", only unbalanced closing ones end a group
+        closing = 0
+        while word.endswith(")") and word.count(")") > word.count("("):
+            closing += 1
+            word = word[:-1]
+
+        if word:
+            tokens.extend(prefix + [word])
+        elif prefix:
+            raise QueryError(f'Dangling "{"".join(prefix)}"')
+        tokens.extend([")"] * closing)
+    return tokens
+
+
+class Parser:
+    def __init__(self, tokens: Iterable[str]):
+        self.tokens = list(tokens)
+        self.position = 0
+
+    def peek(self) -> str | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise QueryError("Unexpected end of query")
+        self.position += 1
+        return token
+
+    def parse(self) -> Predicate:
+        if not self.tokens:
+            return lambda context: True
+        predicate = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError(f'Unexpected "{self.peek()}"')
+        return predicate
+
+    def parse_or(self) -> Predicate:
+        options = [self.parse_and()]
+        while self.peek() is not None and self.peek().lower() == "or":  # type: ignore
+            self.next()
+            options.append(self.parse_and())
+        return _any(options)
+
+    def parse_and(self) -> Predicate:
+        required, optional = [], []
+        while (token := self.peek()) is not None and token != ")" and token.lower() != "or":
+            if token == "~":
+                self.next()
+                optional.append(self.parse_unary())
+            else:
+                required.append(self.parse_unary())
+
+        if optional:
+            required.append(_any(optional))
+        if not required:
+            raise QueryError("Empty expression")
+        return _all(required)
+
+    def parse_unary(self) -> Predicate:
+        token = self.next()
+        if token == "-":
+            return _not(self.parse_unary())
+        elif token == "(":
+            predicate = self.parse_or()
+            if self.next() != ")":
+                raise QueryError('Missing ")"')
+            return predicate
+        elif token == ")":
+            raise QueryError('Unexpected ")"')
+        return _term(token)
+
+
+class Query:
+    """A compiled query which can be matched against a post dict or :class:`PostData`"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self._predicate = Parser(tokenize(text)).parse()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.text!r}>"
+
+    def __call__(self, post: Any) -> bool:
+        return self.matches(post)
+
+    def matches(self, post: Any) -> bool:
+        return self._predicate(Context(post))
+
+
+@lru_cache(maxsize=64)
+def compile_query(text: str) -> Query:
+    return Query(re.sub(r"\s+", " ", text).strip())
@@ -0,0 +1,129 @@
+from functools import wraps
+import logging
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, TypeVar
+
+from telegram.error import RetryAfter
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Thread safe token bucket refilling ``rate`` tokens per second up to ``capacity``
+
+    The rate can be lowered at runtime, e.g. after Telegram answered with a ``RetryAfter``, and recovers step by step
+    back to ``base_rate`` with every successful call.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1, min_rate: float | None = None):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 8
+        self.capacity = capacity
+        self.tokens = capacity
+        self.blocked_until = 0.0
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it"""
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, self.blocked_until - now, 0)
+
+    def acquire(self):
+        if wait := self.reserve():
+            sleep(wait)
+
+    def penalize(self, retry_after: float):
+        """Block for ``retry_after`` seconds and halve the rate"""
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def reward(self):
+        """Move the rate a bit back towards the base rate"""
+        if self.rate < self.base_rate:
+            with self._lock:
+                self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+class RateLimiter:
+    """Per chat and global rate limits for Telegram
+
+    Telegram allows about 20 messages per minute to the same group or channel, one per second to the same private chat
+    and around 30 per second overall. Every chat gets its own :class:`TokenBucket` next to the global one, so sends to
+    different chats can run in parallel. ``RetryAfter`` responses slow the affected chat down automatically.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        group_rate: float = 20 / 60,
+        private_rate: float = 1,
+        group_burst: float = 3,
+        max_retries: int = 3,
+    ):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self._buckets: dict[int | str, TokenBucket] = {}
+        self._lock = Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def bucket(self, chat_id: int | str) -> TokenBucket:
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        with self._lock:
+            if chat_id not in self._buckets:
+                # Groups and channels have negative ids (or are addressed by their @username)
+                if isinstance(chat_id, str) or chat_id < 0:
+                    self._buckets[chat_id] = TokenBucket(self.group_rate, capacity=self.group_burst)
+                else:
+                    self._buckets[chat_id] = TokenBucket(self.private_rate, capacity=1)
+            return self._buckets[chat_id]
+
+    def call(self, chat_id: int | str | None, func: Callable[..., T], *args, **kwargs) -> T:
+        """Call ``func`` once the chat and the global bucket allow it, retrying on ``RetryAfter``"""
+        bucket = self.bucket(chat_id) if chat_id is not None else None
+        retries = 0
+        while True:
+            if bucket:
+                bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except RetryAfter as error:
+                self.logger.warning(f"Hit rate limit for {chat_id}, waiting {error.retry_after}s")
+                (bucket or self.global_bucket).penalize(error.retry_after)
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                continue
+
+            if bucket:
+                bucket.reward()
+            return result
+
+
+def ratelimited(method: Callable) -> Callable:
+    """Decorate a ``Bot.send_*`` method to go through ``self.rate_limiter``"""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        chat_id = kwargs["chat_id"] if "chat_id" in kwargs else (args[0] if args else None)
+        return self.rate_limiter.call(chat_id, method, self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,91 @@
+import logging
+from random import uniform
+from time import monotonic
+from typing import Iterable
+
+# Seconds to wait before fetching again when the last fetch stopped at its page limit
+BACKLOG_DELAY = 1.0
+
+
+class AdaptiveInterval:
+    """Time between two refreshes, following how fast new posts show up
+
+    The rate of new posts is a moving average over the refreshes, the next refresh is planned for when about
+    ``target_posts`` new posts are expected, within ``min_interval`` and ``max_interval`` seconds. A fetch which hit its
+    page limit is continued right away as long as the refresh moved the cursor, failing fetches back off
+    exponentially. Every interval is jittered by ``jitter`` (a fraction), so the polls don't fall into lockstep with
+    anything else.
+    """
+
+    def __init__(
+        self,
+        min_interval: float,
+        max_interval: float,
+        initial: float,
+        target_posts: float = 10,
+        smoothing: float = 0.3,
+        jitter: float = 0.1,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.initial = initial
+        self.target_posts = target_posts
+        self.smoothing = smoothing
+        self.jitter = jitter
+        # New posts per second, unknown until two refreshes went through
+        self.rate: float | None = None
+        self.newest = 0
+        self.backlog = False
+        self.failures = 0
+        self._last_fetch: float | None = None
+        # Refresh no later than this, e.g. when a waiting post leaves its grace period
+        self._due: float | None = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def observe(self, post_ids: Iterable[int], complete: bool = True, now: float | None = None):
+        """Record a successful fetch, ``complete`` is False if it stopped at the page limit"""
+        now = monotonic() if now is None else now
+        new = [post_id for post_id in post_ids if post_id > self.newest]
+
+        # The first fetch and the ones catching up on a backlog return posts which piled up, not the current rate
+        if self._last_fetch is not None and complete and not self.backlog:
+            sample = len(new) / max(now - self._last_fetch, 1)
+            self.rate = sample if self.rate is None else self.smoothing * sample + (1 - self.smoothing) * self.rate
+
+        self.newest = max(self.newest, *new) if new else self.newest
+        self._last_fetch = now
+        self.backlog = not complete
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+
+    def due(self, seconds: float, now: float | None = None):
+        """Make the next refresh happen within ``seconds``"""
+        due = (monotonic() if now is None else now) + seconds
+        self._due = due if self._due is None else min(self._due, due)
+
+    def next(self, now: float | None = None, progressed: bool = True) -> float:
+        """Seconds until the next refresh, ``progressed`` is False if the last refresh didn't move the cursor"""
+        now = monotonic() if now is None else now
+        due, self._due = self._due, None
+        if self.failures:
+            interval = self.min_interval * 2**self.failures
+        elif self.backlog and progressed:
+            return BACKLOG_DELAY
+        elif self.rate is None:
+            interval = self.initial
+        elif self.rate > 0:
+            interval = self.target_posts / self.rate
+        else:
+            interval = self.max_interval
+
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        interval *= uniform(1 - self.jitter, 1 + self.jitter)
+        if due is not None and not self.failures:
+            interval = min(interval, max(due - now, BACKLOG_DELAY))
+        return interval
+
+    def summary(self) -> str:
+        rate = f"{self.rate * 3600:.1f} posts/h" if self.rate is not None else "unknown"
+        return f"Upload rate: {rate}, backlog: {self.backlog}, failures: {self.failures}"
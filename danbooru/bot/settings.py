@@ -7,7 +7,7 @@ from dotenv import load_dotenv
 load_dotenv(".env")
 
 
-def env(name, default=None, required=False, is_bool=False, is_list=False):
+def env(name, default=None, required=False, is_bool=False, is_list=False, separator=","):
     value = os.environ.get(name)
     if required and not name:
         raise KeyError(f'You need to define the environmental variable "{name}"')
@@ -15,7 +15,7 @@ def env(name, default=None, required=False, is_bool=False, is_list=False):
         convert = type(default) if default is not None else list
         if not value:
             return convert() if default is None else default
-        return convert(map(str.strip, value.split(",")))
+        return convert(map(str.strip, value.split(separator)))
     elif is_bool or isinstance(default, bool):
         if value is None:
             return default or False
@@ -50,13 +50,23 @@ NO_FILE = env("NO_FILE", False)
 FORCE_FILE = env("FORCE_FILE", False)
 EXPLICIT_FILE = env("EXPLICIT_FILE", False)
 QUESTIONABLE_FILE = env("QUESTIONABLE_FILE", False)
+# Minimum longer side in px of photos, the smallest pre-rendered Danbooru sample this big is sent instead of the
+# original, 0 always sends the original
+QUALITY = int(env("QUALITY", 0))  # type: ignore
 DATE_FORMAT = env("DATE_FORMAT", "%b %-d '%y at %H:%M")  # Date like "Apr 4 '20 at 14:08"
 
 # Delay before posts are sent after upload so that first corrections can take place
 GRACE_PERIOD = int(env("GRACE_PERIOD", 0))  # type: ignore
 
 SEARCH_TAGS = env("SEARCH_TAGS", "rating:safe")  # AND filter
-POST_TAG_FILTER = env("POST_TAG_FILTER", set())  # OR filter
+# Additional searches merged with SEARCH_TAGS, one per line as commas are part of Danbooru queries (rating:g,s)
+EXTRA_SEARCH_TAGS = env("EXTRA_SEARCH_TAGS", [], separator="\n")
+SUBSCRIBER_SEARCH = env("SUBSCRIBER_SEARCH", False)  # Also search for tags subscribed by other chats
+QUERY_CONCURRENCY = int(env("QUERY_CONCURRENCY", 4))  # type: ignore
+# Pages of 200 posts fetched per search and refresh, 0 for no limit
+MAX_PAGES = int(env("MAX_PAGES", 10))  # type: ignore
+# Query evaluated locally, see danbooru.bot.query. Read as a whole, commas belong to metatags like rating:g,s
+POST_TAG_FILTER = env("POST_TAG_FILTER", "")
 MAX_TAGS = int(env("MAX_TAGS", 15))  # type: ignore
 SHOWN_TAGS = env(
     "SHOWN_TAGS",
@@ -79,9 +89,43 @@ SHOWN_TAGS = env(
 LAST_100_TRACK = env(
     "LAST_100_TRACK", False
 )  # Track last 100 posts base on SEARCH_TAGS to recognize edited posts that newly match your criteria
-
-# in min
+# Follow Danbooru's post version history to recognize edited posts that newly match your criteria
+EDIT_TRACK = env("EDIT_TRACK", False)
+# Amount of handled post ids remembered for LAST_100_TRACK and EDIT_TRACK
+TRACKER_SIZE = int(env("TRACKER_SIZE", 10000))  # type: ignore
+
+# Attempts per delivery before it is given up, failed deliveries are retried with exponential backoff
+RETRY_ATTEMPTS = int(env("RETRY_ATTEMPTS", 5))  # type: ignore
+# Amount of posts downloaded and converted in the background while another one is sent
+PREFETCH = int(env("PREFETCH", 3))  # type: ignore
+# in MiB, prefetching pauses while prepared and in-flight posts take up more than this
+MEMORY_BUDGET = int(env("MEMORY_BUDGET", 512))  # type: ignore
+# in MiB, size of the downloaded and converted media kept in CONFIG_FOLDER/media, 0 disables the cache
+MEDIA_CACHE_SIZE = int(env("MEDIA_CACHE_SIZE", 2048))  # type: ignore
+# Amount of ffmpeg conversions running at the same time and seconds after which one is killed
+TRANSCODE_WORKERS = int(env("TRANSCODE_WORKERS", os.cpu_count() or 2))  # type: ignore
+TRANSCODE_TIMEOUT = int(env("TRANSCODE_TIMEOUT", 300))  # type: ignore
+
+# Telegram rate limits: messages per second overall and messages per minute to the same group or channel
+GLOBAL_RATE = float(env("GLOBAL_RATE", 30))  # type: ignore
+GROUP_RATE = float(env("GROUP_RATE", 20))  # type: ignore
+# Amount of chats a post is sent to in parallel
+FANOUT_WORKERS = int(env("FANOUT_WORKERS", 8))  # type: ignore
+
+# Danbooru rate limits: API calls and media downloads per second, retries of rate limited (429/503) and failed requests
+DANBOORU_RATE = float(env("DANBOORU_RATE", 10))  # type: ignore
+DOWNLOAD_RATE = float(env("DOWNLOAD_RATE", 20))  # type: ignore
+HTTP_RETRIES = int(env("HTTP_RETRIES", 5))  # type: ignore
+# Amount of kept alive connections to each Danbooru host
+HTTP_POOL_SIZE = int(env("HTTP_POOL_SIZE", 10))  # type: ignore
+
+# in min, interval until the upload rate is known
 RELOAD_INTEVAL = int(env("RELOAD_INTEVAL", 5))  # type: ignore
+# The refresh interval adapts to the upload rate: about RELOAD_TARGET new posts per refresh, at least
+# RELOAD_MIN_SECONDS and at most RELOAD_MAX_SECONDS apart
+RELOAD_MIN_SECONDS = int(env("RELOAD_MIN_SECONDS", 30))  # type: ignore
+RELOAD_MAX_SECONDS = int(env("RELOAD_MAX_SECONDS", 900))  # type: ignore
+RELOAD_TARGET = int(env("RELOAD_TARGET", 10))  # type: ignore
 
 SERVICE = {
     "name": "danbooru",
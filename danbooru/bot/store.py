@@ -0,0 +1,201 @@
+from contextlib import contextmanager
+from copy import deepcopy
+import json
+import logging
+from pathlib import Path
+import sqlite3
+from threading import RLock
+from typing import Any, Iterable, Iterator
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracker (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    post_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    group_name TEXT,
+    method TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (post_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+CREATE TABLE IF NOT EXISTS files (
+    md5 TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    PRIMARY KEY (md5, kind)
+);
+"""
+
+
+class Store:
+    """Embedded SQLite database holding the bot state
+
+    Cursors and other small values live in ``state``, chat configs (including their subscriptions) one row per chat
+    in ``chats``, the tracked post ids in ``tracker``, the delivery journal in ``outbox`` and Telegram file ids of
+    uploaded files in ``files``. State and chat configs are cached in memory, so reads never hit the database. The
+    database runs in WAL mode and every write is its own small transaction.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._lock = RLock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+        self._state: dict[str, Any] = {
+            key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM state")
+        }
+        self._chats: dict[str, dict] = {
+            str(chat_id): json.loads(config) for chat_id, config in self.connection.execute("SELECT * FROM chats")
+        }
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+
+    # State
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._state.get(key, default)
+
+    def set(self, key: str, value: Any):
+        self.set_many({key: value})
+
+    def set_many(self, values: dict[str, Any]):
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in values.items()],
+            )
+            self._state.update(values)
+
+    # Chats
+
+    def chats(self) -> dict[str, dict]:
+        """All chat configs by chat id, treat them as read only"""
+        return dict(self._chats)
+
+    def chat(self, chat_id: int | str) -> dict | None:
+        config = self._chats.get(str(chat_id))
+        return deepcopy(config) if config is not None else None
+
+    def set_chat(self, chat_id: int | str, config: dict):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO chats (chat_id, config) VALUES (?, ?)",
+                (int(chat_id), json.dumps(config, sort_keys=True)),
+            )
+            self._chats[str(chat_id)] = deepcopy(config)
+
+    def delete_chat(self, chat_id: int | str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM chats WHERE chat_id = ?", (int(chat_id),))
+            self._chats.pop(str(chat_id), None)
+
+    # Tracker
+
+    def tracked(self, limit: int) -> list[int]:
+        """The ``limit`` most recently tracked post ids, oldest first"""
+        with self._lock:
+            rows = self.connection.execute("SELECT post_id FROM tracker ORDER BY seq DESC LIMIT ?", (limit,))
+            return [post_id for post_id, in rows][::-1]
+
+    def track(self, post_ids: Iterable[int]):
+        with self.transaction() as connection:
+            connection.executemany("INSERT OR IGNORE INTO tracker (post_id) VALUES (?)", [(id_,) for id_ in post_ids])
+
+    def evicted(self, size: int) -> int:
+        """Highest post id which is not among the ``size`` most recently tracked ones anymore, 0 if none"""
+        with self._lock:
+            (evicted,) = self.connection.execute(
+                "SELECT MAX(post_id) FROM tracker WHERE seq <= (SELECT MAX(seq) FROM tracker) - ?",
+                (size,),
+            ).fetchone()
+        return max(evicted or 0, self.get("tracker_evicted", 0))
+
+    def trim_tracker(self, size: int):
+        with self.transaction() as connection:
+            # The deleted ids are forgotten, but not that they were tracked once
+            evicted = self.evicted(size)
+            connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", ("tracker_evicted", json.dumps(evicted))
+            )
+            self._state["tracker_evicted"] = evicted
+            connection.execute(
+                "DELETE FROM tracker WHERE seq <= (SELECT MAX(seq) FROM tracker) - ?",
+                (size,),
+            )
+
+    # Files
+
+    def file_id(self, md5: str, kind: str) -> str | None:
+        """Telegram file id of a file already uploaded as ``kind`` (photo, animation, video or document)"""
+        with self._lock:
+            row = self.connection.execute("SELECT file_id FROM files WHERE md5 = ? AND kind = ?", (md5, kind))
+            return next((file_id for file_id, in row), None)
+
+    def set_file_id(self, md5: str, kind: str, file_id: str):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO files (md5, kind, file_id) VALUES (?, ?, ?)", (md5, kind, file_id)
+            )
+
+    def forget_file_id(self, md5: str, kind: str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM files WHERE md5 = ? AND kind = ?", (md5, kind))
+
+    # Migration
+
+    def import_files(self, folder: Path):
+        """Import the state files used by older versions, only done once"""
+        if self.get("imported_files"):
+            return
+
+        values: dict[str, Any] = {"imported_files": True}
+        if (file := folder / "last_post.txt").exists() and (content := file.read_text().strip()):
+            values["last_post_id"] = int(content)
+        if (file := folder / "post_versions_cursor.txt").exists() and (content := file.read_text().strip()):
+            values["post_versions_cursor"] = int(content)
+        if (file := folder / "query_cursors.json").exists():
+            for tags, cursor in json.loads(file.read_text() or "{}").items():
+                values[f"query_cursor:{tags}"] = cursor
+
+        if (file := folder / "sub_config.json").exists():
+            for chat_id, config in json.loads(file.read_text() or "{}").items():
+                self.set_chat(chat_id, config)
+        if (file := folder / "tracker.txt").exists():
+            self.track(map(int, file.read_text().split()))
+
+        self.set_many(values)
+        self.logger.info(f"Imported state files from {folder}")
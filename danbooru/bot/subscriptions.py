@@ -0,0 +1,147 @@
+from collections import defaultdict
+from dataclasses import dataclass
+import sys
+from typing import Iterable, Iterator
+
+
+@dataclass(eq=False)
+class Subscription:
+    chat_id: int
+    group: str
+    good: frozenset[str]
+    bad: frozenset[str]
+    strict: bool = True
+    position: int = 0
+
+    def matches(self, tags: set[str], hits: int) -> bool:
+        if self.bad & tags:
+            return False
+        if self.strict:
+            return hits == len(self.good)
+        return hits > 0
+
+
+class SubscriptionIndex:
+    """Inverted index of tag -> subscriptions
+
+    Every subscription group of every chat is compiled once into a :class:`Subscription`. Routing a post only touches
+    the subscriptions its tags actually hit instead of all chats and groups.
+    """
+
+    def __init__(self, config: dict | None = None):
+        self._by_tag: dict[str, list[Subscription]] = defaultdict(list)
+        self._unconditional: list[Subscription] = []
+        self._by_chat: dict[int, list[Subscription]] = {}
+        self._chat_order: dict[int, int] = {}
+        self._next_position = 0
+        if config:
+            self.rebuild(config)
+
+    def __len__(self) -> int:
+        return sum(map(len, self._by_chat.values()))
+
+    def __contains__(self, chat_id: int) -> bool:
+        return int(chat_id) in self._by_chat
+
+    def __iter__(self) -> Iterator[Subscription]:
+        for subscriptions in self._by_chat.values():
+            yield from subscriptions
+
+    @staticmethod
+    def intern_tags(tags: Iterable[str]) -> set[str]:
+        return {sys.intern(tag) for tag in tags if tag}
+
+    def rebuild(self, config: dict):
+        self._by_tag.clear()
+        self._unconditional.clear()
+        self._by_chat.clear()
+        self._chat_order.clear()
+        for chat_id, chat_config in config.items():
+            self.update_chat(chat_id, chat_config)
+
+    def update_chat(self, chat_id: int | str, chat_config: dict | None):
+        chat_id = int(chat_id)
+        self.remove_chat(chat_id)
+        if not chat_config:
+            return
+
+        if chat_id not in self._chat_order:
+            self._chat_order[chat_id] = self._next_position
+            self._next_position += 1
+
+        subscriptions = []
+        for position, (group, check_tags) in enumerate(chat_config.get("subs", {}).items()):
+            good = frozenset(self.intern_tags(tag for tag in check_tags if not tag.startswith("-")))
+            bad = frozenset(self.intern_tags(tag[1:] for tag in check_tags if tag.startswith("-")))
+            strict = group != "OR"
+            if not strict and not good:
+                # An OR group without positive tags can never match
+                continue
+
+            subscription = Subscription(chat_id, group, good, bad, strict, position)
+            subscriptions.append(subscription)
+            if good:
+                for tag in good:
+                    self._by_tag[tag].append(subscription)
+            else:
+                self._unconditional.append(subscription)
+
+        self._by_chat[chat_id] = subscriptions
+
+    def remove_chat(self, chat_id: int | str):
+        chat_id = int(chat_id)
+        subscriptions = self._by_chat.pop(chat_id, [])
+        for subscription in subscriptions:
+            for tag in subscription.good:
+                entries = self._by_tag[tag]
+                entries.remove(subscription)
+                if not entries:
+                    del self._by_tag[tag]
+            if not subscription.good:
+                self._unconditional.remove(subscription)
+
+    def queries(self, tag_limit: int) -> set[str]:
+        """Derive Danbooru searches covering all subscriptions
+
+        OR groups result in one search per tag, other groups in one search with their first ``tag_limit`` tags. Groups
+        without positive tags cannot be expressed as a search and are skipped. The results are broader than the
+        subscriptions themselves, the exact matching happens in :meth:`route`.
+        """
+        queries = set()
+        for subscription in self:
+            if not subscription.good:
+                continue
+            elif subscription.strict:
+                queries.add(" ".join(sorted(subscription.good)[:tag_limit]))
+            else:
+                queries.update(subscription.good)
+        return queries
+
+    def route(self, tags: set[str]) -> dict[int, str]:
+        """Find all chats interested in a post with the given tags
+
+        Args:
+            tags (:obj:`set`): Extended tags of the post (including rating and cleaned telegram tags)
+
+        Returns:
+            :obj:`dict`: chat_id -> name of the first matching group, in the order the chats were added
+        """
+        hits: dict[Subscription, int] = defaultdict(int)
+        for tag in tags:
+            for subscription in self._by_tag.get(tag, ()):
+                hits[subscription] += 1
+        for subscription in self._unconditional:
+            hits.setdefault(subscription, 0)
+
+        matched: dict[int, Subscription] = {}
+        for subscription, count in hits.items():
+            current = matched.get(subscription.chat_id)
+            if current and current.position < subscription.position:
+                continue
+            if subscription.matches(tags, count):
+                matched[subscription.chat_id] = subscription
+
+        return {
+            chat_id: matched[chat_id].group
+            for chat_id in sorted(matched, key=lambda chat_id: self._chat_order[chat_id])
+        }
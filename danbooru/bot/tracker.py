@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterable, Iterator
+
+from danbooru.bot.store import Store
+
+
+class Tracker:
+    """Bounded, ordered set of the most recently handled post ids
+
+    Membership checks are O(1). New ids are appended to the ``tracker`` table of the store, rows outside the window
+    are deleted (compacted) once ``compact_factor`` times the window size were written. ``evicted`` is the highest id
+    which ever left the window, ids up to it may have been handled even if they are not tracked.
+    """
+
+    def __init__(self, store: Store, size: int = 10_000, compact_factor: int = 2):
+        self.store = store
+        self.size = size
+        self.compact_factor = compact_factor
+        self._ids: OrderedDict[int, None] = OrderedDict()
+        self.evicted = 0
+        self._written = 0
+        self._lock = Lock()
+
+        self.load()
+
+    def __contains__(self, item: int) -> bool:
+        return item in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._ids))
+
+    def __bool__(self) -> bool:
+        return bool(self._ids)
+
+    def load(self):
+        with self._lock:
+            self._ids = OrderedDict.fromkeys(self.store.tracked(self.size))
+            self.evicted = self.store.evicted(self.size)
+
+    def append(self, item: int):
+        self.extend([item])
+
+    def extend(self, items: Iterable[int]):
+        items = [item for item in items if item not in self._ids]
+        if not items:
+            return
+
+        with self._lock:
+            self._ids.update(OrderedDict.fromkeys(items))
+            while len(self._ids) > self.size:
+                evicted, _ = self._ids.popitem(last=False)
+                self.evicted = max(self.evicted, evicted)
+
+            self.store.track(items)
+            self._written += len(items)
+            if self._written >= self.size * (self.compact_factor - 1):
+                self.store.trim_tracker(self.size)
+                self._written = 0
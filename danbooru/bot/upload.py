@@ -0,0 +1,37 @@
+from mmap import ACCESS_READ, mmap
+import os
+from typing import IO
+
+from telegram.files.inputfile import InputFile
+
+
+class MappedInputFile(InputFile):
+    """:class:`InputFile` backed by a read only memory map of a file on disk instead of a copy of its content
+
+    Pages are loaded from the page cache and can be dropped again by the OS, so a prepared input file costs no heap
+    memory. This ends with the upload: the request body is encoded into a buffer holding a full copy of the file (see
+    ``nbytes``). The map stays valid after the file was closed or deleted.
+    """
+
+    def __init__(
+        self,
+        file: IO[bytes],
+        filename: str | None = None,
+        attach: bool | None = None,
+        variant: str | None = None,
+    ):
+        content: mmap | bytes = b""
+        if os.fstat(file.fileno()).st_size:
+            content = mmap(file.fileno(), 0, access=ACCESS_READ)
+
+        # Only the head is needed to detect the mime type
+        super(MappedInputFile, self).__init__(content[:1024], filename=filename, attach=attach)
+        self.input_file_content = content  # type: ignore
+        # Which rendition of the post this is, e.g. a Danbooru sample instead of the original
+        self.variant = variant
+
+    @property
+    def nbytes(self) -> int:
+        """Heap memory taken while this file is uploaded, the multipart body is built in a ``BytesIO`` and copied out
+        of it once more"""
+        return 2 * len(self.input_file_content)
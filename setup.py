@@ -17,12 +17,11 @@ setup(
     install_requires=[
         "emoji==2.2.0",
         "ffmpeg-python==0.2.0",
-        "ffprobe-python==1.0.3",
         "Pybooru==4.2.2",
         "python-dotenv==0.21.1",
         "python-telegram-bot==13.15",
         "pyvips==2.2.1",
-        "requests-html==0.10.0",
+        "requests==2.28.2",
         "timeout-decorator==0.5.0",
         "yarl==1.8.2",
     ],